@@ -11,7 +11,9 @@ from FileStream.bot import FileStream
 from FileStream.server import web_server
 from FileStream.bot.clients import initialize_clients
 from FileStream.utils.background_tasks import background_tasks
+from FileStream.utils.file_properties import db
 from FileStream.utils.multi_bot_manager import multi_bot_manager
+from FileStream.utils.custom_dl import warm_media_sessions
 import signal
 
 # Remove Flask to avoid port conflicts - aiohttp will handle everything
@@ -47,6 +49,8 @@ async def start_services():
 
     print("---------------------- Initializing Clients ----------------------")
     await initialize_clients()
+    if Server.PREWARM_MEDIA_SESSIONS:
+        await warm_media_sessions()
     print("------------------------------ DONE ------------------------------\n")
 
     print("--------------------- Initializing Multi-Bot System ---------------")
@@ -62,6 +66,10 @@ async def start_services():
         print("Multi-bot mode: ❌ Disabled")
     print("------------------------------ DONE ------------------------------\n")
 
+    print("---------------------- Preparing Database Indexes -----------------")
+    await db.ensure_indexes()
+    print("------------------------------ DONE ------------------------------\n")
+
     print("--------------------- Starting Background Tasks -------------------")
     await background_tasks.start_background_tasks()
     print("------------------------------ DONE ------------------------------\n")
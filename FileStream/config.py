@@ -51,5 +51,51 @@ class Server:
         "s" if HAS_SSL else "", FQDN, "" if NO_PORT else ":" + str(PORT)
     )
 
-
-
+    # Streaming performance
+    PREFETCH_PARTS = int(env.get("PREFETCH_PARTS", "4"))  # GetFile requests kept in flight per stream
+    PREFETCH_BYTES = int(env.get("PREFETCH_BYTES", str(8 * 1024 * 1024)))  # Byte budget for in-flight chunks per stream
+    STRIPE_MIN_SIZE = int(env.get("STRIPE_MIN_SIZE", str(64 * 1024 * 1024)))  # Ranges at least this big are split across clients
+    STRIPE_CLIENTS = int(env.get("STRIPE_CLIENTS", "3"))  # Max clients serving one striped download, 1 disables striping
+    CHUNK_CACHE_DIR = str(env.get("CHUNK_CACHE_DIR", "chunk_cache"))  # Directory of the on-disk chunk cache
+    CHUNK_CACHE_SIZE = int(env.get("CHUNK_CACHE_SIZE", str(1024 * 1024 * 1024)))  # On-disk chunk cache budget in bytes, 0 disables it
+    CHUNK_CACHE_PENDING_WRITES = int(env.get("CHUNK_CACHE_PENDING_WRITES", "16"))  # Background disk cache writes in flight, chunks past it aren't written
+    MEMORY_CACHE_SIZE = int(env.get("MEMORY_CACHE_SIZE", str(64 * 1024 * 1024)))  # In-memory hot chunk cache budget in bytes, 0 disables it
+    MIN_CHUNK_SIZE = int(env.get("MIN_CHUNK_SIZE", str(64 * 1024)))  # Smallest GetFile chunk, used for short range probes
+    START_CHUNK_SIZE = int(env.get("START_CHUNK_SIZE", str(256 * 1024)))  # First chunk of a long range, doubled as the stream ramps up
+    MAX_CHUNK_SIZE = int(env.get("MAX_CHUNK_SIZE", str(1024 * 1024)))  # Largest GetFile chunk Telegram accepts
+    CHUNK_RAMP_LATENCY = float(env.get("CHUNK_RAMP_LATENCY", "1.0"))  # Chunks only grow while they arrive faster than this (seconds)
+    MEDIA_SESSIONS_PER_DC = int(env.get("MEDIA_SESSIONS_PER_DC", "2"))  # Media connections each client may open per DC
+    PREWARM_MEDIA_SESSIONS = str(env.get("PREWARM_MEDIA_SESSIONS", "1").lower()) in ("1", "true", "t", "yes", "y")
+    SESSION_PING_INTERVAL = int(env.get("SESSION_PING_INTERVAL", "60"))  # Seconds between media session health checks
+    SESSION_PING_TIMEOUT = int(env.get("SESSION_PING_TIMEOUT", "10"))  # Seconds before a media session is considered dead
+    SESSION_RETRY_BACKOFF = int(env.get("SESSION_RETRY_BACKOFF", "2"))  # Seconds to wait after a failed media session creation, doubled per failure
+    SESSION_RETRY_MAX_BACKOFF = int(env.get("SESSION_RETRY_MAX_BACKOFF", "120"))
+    HEDGE_REQUESTS = str(env.get("HEDGE_REQUESTS", "0").lower()) in ("1", "true", "t", "yes", "y")
+    HEDGE_PERCENTILE = float(env.get("HEDGE_PERCENTILE", "95"))  # Latency percentile of the DC after which a chunk is hedged
+    HEDGE_MIN_DELAY = float(env.get("HEDGE_MIN_DELAY", "0.5"))  # Never hedge a chunk earlier than this (seconds)
+    HEDGE_BUDGET = float(env.get("HEDGE_BUDGET", "0.05"))  # Max extra requests per GetFile sent
+    CDN_DOWNLOADS = str(env.get("CDN_DOWNLOADS", "0").lower()) in ("1", "true", "t", "yes", "y")  # Let Telegram redirect popular files to its CDN DCs
+    BALANCER_ESTIMATE_BYTES = int(env.get("BALANCER_ESTIMATE_BYTES", str(8 * 1024 * 1024)))  # Stream size clients are scored on
+    BALANCER_DEFAULT_THROUGHPUT = float(env.get("BALANCER_DEFAULT_THROUGHPUT", str(2 * 1024 * 1024)))  # Bytes/s assumed before any chunk was measured
+    BALANCER_ERROR_PENALTY = float(env.get("BALANCER_ERROR_PENALTY", "10"))  # Seconds added for a client failing every request
+    MAX_STREAMS = int(env.get("MAX_STREAMS", "0"))  # Concurrent streams across all clients, 0 for no limit
+    MAX_CLIENT_STREAMS = int(env.get("MAX_CLIENT_STREAMS", "25"))  # Concurrent streams per client, 0 for no limit
+    STREAM_QUEUE_SIZE = int(env.get("STREAM_QUEUE_SIZE", "20"))  # Requests that may wait for a free stream slot
+    STREAM_QUEUE_TIMEOUT = float(env.get("STREAM_QUEUE_TIMEOUT", "5"))  # Seconds a request waits for a slot before a 503
+    RETRY_AFTER = int(env.get("RETRY_AFTER", "10"))  # Retry-After sent with 503 responses
+    BREAKER_WINDOW = int(env.get("BREAKER_WINDOW", "20"))  # Recent upstream requests the breaker error rate is computed over
+    BREAKER_MIN_FAILURES = int(env.get("BREAKER_MIN_FAILURES", "5"))  # Failures in the window before a client can be quarantined
+    BREAKER_ERROR_RATE = float(env.get("BREAKER_ERROR_RATE", "0.5"))  # Failure ratio in the window that opens the breaker
+    BREAKER_COOLDOWN = int(env.get("BREAKER_COOLDOWN", "30"))  # Seconds a tripped client stays out of rotation, doubled per failed probe
+    BREAKER_MAX_COOLDOWN = int(env.get("BREAKER_MAX_COOLDOWN", "600"))
+    BREAKER_AUTH_COOLDOWN = int(env.get("BREAKER_AUTH_COOLDOWN", "300"))  # Seconds a client with an auth error stays out of rotation
+    BREAKER_PROBE_TIMEOUT = int(env.get("BREAKER_PROBE_TIMEOUT", "30"))  # Seconds before another half-open probe stream is let through
+    META_CACHE_SIZE = int(env.get("META_CACHE_SIZE", "10000"))  # Files whose HTTP metadata is kept in memory, 0 disables the cache
+    META_CACHE_TTL = int(env.get("META_CACHE_TTL", "300"))  # Seconds before cached metadata is read from the database again
+    FILE_ID_CACHE_SIZE = int(env.get("FILE_ID_CACHE_SIZE", "1000"))  # (client, file) FileIds kept in memory, 0 disables the cache
+    FILE_ID_CACHE_TTL = int(env.get("FILE_ID_CACHE_TTL", "3600"))  # Seconds a resolved FileId is reused, capped by the file's expiry
+    FILE_DOC_CACHE_SIZE = int(env.get("FILE_DOC_CACHE_SIZE", "5000"))  # File documents kept in memory, 0 disables the cache
+    FILE_DOC_CACHE_TTL = int(env.get("FILE_DOC_CACHE_TTL", "60"))  # Seconds a file document is reused without asking MongoDB
+    FILE_DOC_NEGATIVE_SIZE = int(env.get("FILE_DOC_NEGATIVE_SIZE", "10000"))  # Deleted or unknown file ids remembered, 0 disables it
+    FILE_DOC_NEGATIVE_TTL = int(env.get("FILE_DOC_NEGATIVE_TTL", "300"))  # Seconds a deleted or unknown file id is remembered
+    MONGO_TTL_EXPIRY = str(env.get("MONGO_TTL_EXPIRY", "0").lower()) in ("1", "true", "t", "yes", "y")  # Let a MongoDB TTL index delete expired files instead of the polling cleanup task
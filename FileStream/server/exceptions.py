@@ -2,4 +2,10 @@ class InvalidHash(Exception):
     message = "Invalid hash"
 
 class FIleNotFound(Exception):
-    message = "File not found"
\ No newline at end of file
+    message = "File not found"
+
+class ServerOverloaded(Exception):
+    message = "Server is busy, please try again later"
+
+class RangeNotSatisfiable(Exception):
+    message = "416: Range not satisfiable"
@@ -1,15 +1,22 @@
 import time
-import math
 import logging
-import mimetypes
 import traceback
 from aiohttp import web
 from aiohttp.http_exceptions import BadStatusLine
 from FileStream.bot import multi_clients, work_loads, FileStream
 from FileStream.config import Telegram, Server
-from FileStream.server.exceptions import FIleNotFound, InvalidHash
+from FileStream.server.exceptions import FIleNotFound, InvalidHash, ServerOverloaded, RangeNotSatisfiable
 from FileStream import utils, StartTime, __version__
-from FileStream.utils.render_template import render_page
+from FileStream.utils.render_template import render_page, page_etag
+from FileStream.utils.custom_dl import get_byte_streamer
+from FileStream.utils.balancer import select_client, get_file_dc, balancer_status
+from FileStream.utils.admission import AdmissionSlot, admission
+from FileStream.utils.http_range import parse_range, if_range_matches, MultipartRanges
+from FileStream.utils.conditional import is_not_modified, validator_headers
+from FileStream.utils.file_properties import db
+from FileStream.utils.file_meta import file_meta_cache
+from FileStream.utils.file_id_cache import file_id_cache
+from FileStream.utils.database import file_doc_cache
 
 routes = web.RouteTableDef()
 
@@ -17,6 +24,10 @@ routes = web.RouteTableDef()
 async def root_route_handler(_):
     return web.json_response(
         {
+            "clients": await balancer_status(),
+            "admission": admission.status(),
+            "file_id_cache": file_id_cache.stats(),
+            "file_doc_cache": file_doc_cache.stats(),
             "server_status": "running",
             "uptime": utils.get_readable_time(time.time() - StartTime),
             "telegram_bot": "@" + FileStream.username,
@@ -35,7 +46,17 @@ async def root_route_handler(_):
 async def stream_handler(request: web.Request):
     try:
         path = request.match_info["path"]
-        return web.Response(text=await render_page(path), content_type='text/html')
+        try:
+            file_data = await db.get_file(path)
+        except FIleNotFound:
+            file_data = None
+        etag = page_etag(file_data) if file_data else None
+        if etag and is_not_modified(request.headers, request.method, etag):
+            return web.Response(status=304, headers={"ETag": etag})
+        response = web.Response(text=await render_page(path, file_data), content_type='text/html')
+        if etag:
+            response.headers["ETag"] = etag
+        return response
     except InvalidHash as e:
         raise web.HTTPForbidden(text=e.message)
     except FIleNotFound as e:
@@ -53,6 +74,8 @@ async def stream_handler(request: web.Request):
         raise web.HTTPForbidden(text=e.message)
     except FIleNotFound as e:
         raise web.HTTPNotFound(text=e.message)
+    except ServerOverloaded as e:
+        raise web.HTTPServiceUnavailable(text=e.message, headers={"Retry-After": str(Server.RETRY_AFTER)})
     except (AttributeError, BadStatusLine, ConnectionResetError):
         pass
     except Exception as e:
@@ -61,107 +84,164 @@ async def stream_handler(request: web.Request):
         logging.debug(traceback.format_exc())
         raise web.HTTPInternalServerError(text=str(e))
 
-class_cache = {}
+async def get_stripes(db_id: str, index: int, tg_connect, file_id) -> list:
+    """
+    Picks the least loaded clients (the serving one first) to share a single large download.
+    Clients that cannot resolve the file are left out.
+    """
+    stripes = [(index, tg_connect, file_id)]
+    others = sorted((i for i in multi_clients if i != index and i in work_loads), key=work_loads.get)
+    for other in others:
+        if len(stripes) >= Server.STRIPE_CLIENTS:
+            break
+        if not admission.try_acquire(other):
+            continue
+        try:
+            streamer = get_byte_streamer(other)
+            stripes.append((other, streamer, await streamer.get_file_properties(db_id, multi_clients)))
+        except Exception as e:
+            logging.warning(f"Client {other} can't join striped download of {db_id}: {e}")
+            await admission.release(other)
+    return stripes
 
 async def media_streamer(request: web.Request, db_id: str):
-    range_header = request.headers.get("Range", 0)
-    
+    range_header = request.headers.get("Range")
+
+    # Everything short of the bytes themselves is answered from the cached metadata, without touching Telegram
+    meta = await file_meta_cache.get(db_id)
+    if meta.expired:
+        raise FIleNotFound
+    if is_not_modified(request.headers, request.method, meta.etag, meta.last_modified):
+        headers = validator_headers(meta.etag, meta.last_modified)
+        headers["Cache-Control"] = "public, max-age=86400"
+        return web.Response(status=304, headers=headers)
+
+    ranges = None
+    if range_header and if_range_matches(request.headers.get("If-Range"), meta.etag, meta.last_modified):
+        try:
+            ranges = parse_range(range_header, meta.file_size)
+        except RangeNotSatisfiable as e:
+            return web.Response(
+                status=416,
+                body=e.message,
+                headers={"Content-Range": f"bytes */{meta.file_size}"},
+            )
+
+    disposition = "attachment"
+    # if "video/" in meta.mime_type or "audio/" in meta.mime_type:
+    #     disposition = "inline"
+
+    # Enhanced headers for better download speed
+    headers = {
+        "Content-Type": meta.mime_type,
+        "Content-Disposition": f'{disposition}; filename="{meta.file_name}"',
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "public, max-age=86400",  # 24 hours cache
+        "Connection": "keep-alive",
+        "X-Content-Type-Options": "nosniff",
+        **validator_headers(meta.etag, meta.last_modified),
+    }
+    multipart = None
+    if ranges and len(ranges) > 1:
+        multipart = MultipartRanges(ranges, meta.file_size, meta.mime_type)
+        headers["Content-Type"] = multipart.content_type
+        headers["Content-Length"] = str(multipart.content_length())
+    else:
+        from_bytes, until_bytes = ranges[0] if ranges else (0, meta.file_size - 1)
+        headers["Content-Length"] = str(until_bytes - from_bytes + 1)
+        if ranges:
+            headers["Content-Range"] = f"bytes {from_bytes}-{until_bytes}/{meta.file_size}"
+
+    response = web.StreamResponse(status=206 if ranges else 200, headers=headers)
+    if request.method == "HEAD" or headers["Content-Length"] == "0":
+        # HEAD and empty responses need no client at all
+        await response.prepare(request)
+        await response.write_eof()
+        return response
+
     # Enhanced error handling for empty work_loads
     if not work_loads:
         logging.error("No clients available - work_loads is empty")
         raise web.HTTPServiceUnavailable(text="No clients available")
     
+    dc_id = await get_file_dc(db_id)
+    slot = AdmissionSlot(await admission.acquire(lambda available: select_client(dc_id, available)))
     try:
-        # Safe client selection with fallback
-        index = min(work_loads, key=work_loads.get)
-        if index not in multi_clients:
-            # Fallback to first available client
-            index = next(iter(multi_clients.keys()))
-            logging.warning(f"Selected client {index} not in multi_clients, using fallback")
-        
-        faster_client = multi_clients[index]
-    except (ValueError, KeyError) as e:
-        logging.error(f"Error selecting client: {e}")
-        # Emergency fallback to any available client
-        if multi_clients:
-            index = next(iter(multi_clients.keys()))
-            faster_client = multi_clients[index]
-            logging.warning(f"Using emergency fallback client {index}")
-        else:
-            raise web.HTTPServiceUnavailable(text="No clients available")
-    
+        return await stream_file(request, response, db_id, slot, ranges, multipart)
+    finally:
+        # The stream may have failed over, the slot then sits on the client it ended on
+        await admission.release(slot.index)
+
+async def stream_file(request: web.Request, response: web.StreamResponse, db_id: str, slot: AdmissionSlot, ranges, multipart):
+    index = slot.index
     if Telegram.MULTI_CLIENT:
         logging.info(f"Client {index} is now serving {request.headers.get('X-FORWARDED-FOR',request.remote)}")
 
-    if faster_client in class_cache:
-        tg_connect = class_cache[faster_client]
-        logging.debug(f"Using cached ByteStreamer object for client {index}")
-    else:
-        logging.debug(f"Creating new ByteStreamer object for client {index}")
-        tg_connect = utils.ByteStreamer(faster_client)
-        class_cache[faster_client] = tg_connect
+    tg_connect = get_byte_streamer(index)
     logging.debug("before calling get_file_properties")
     file_id = await tg_connect.get_file_properties(db_id, multi_clients)
     logging.debug("after calling get_file_properties")
-    
-    file_size = file_id.file_size
 
-    if range_header:
-        from_bytes, until_bytes = range_header.replace("bytes=", "").split("-")
-        from_bytes = int(from_bytes)
-        until_bytes = int(until_bytes) if until_bytes else file_size - 1
-    else:
-        from_bytes = request.http_range.start or 0
-        until_bytes = (request.http_range.stop or file_size) - 1
-
-    if (until_bytes > file_size) or (from_bytes < 0) or (until_bytes < from_bytes):
-        return web.Response(
-            status=416,
-            body="416: Range not satisfiable",
-            headers={"Content-Range": f"bytes */{file_size}"},
+    stripes = []
+    slots = [slot]
+    if multipart:
+        body = multipart.body(
+            lambda start, end: tg_connect.yield_file(file_id, index, start, end, db_id, slot)
         )
+    else:
+        from_bytes, until_bytes = ranges[0] if ranges else (0, file_id.file_size - 1)
+        req_length = until_bytes - from_bytes + 1
 
-    # Optimize chunk size for better performance
-    chunk_size = 1024 * 1024 * 2  # 2MB chunks for better speed
-    until_bytes = min(until_bytes, file_size - 1)
-
-    offset = from_bytes - (from_bytes % chunk_size)
-    first_part_cut = from_bytes - offset
-    last_part_cut = until_bytes % chunk_size + 1
-
-    req_length = until_bytes - from_bytes + 1
-    part_count = math.ceil(until_bytes / chunk_size) - math.floor(offset / chunk_size)
-    
-    # Enhanced headers for better download speed
-    headers = {
-        "Content-Type": f"{mime_type}",
-        "Content-Range": f"bytes {from_bytes}-{until_bytes}/{file_size}",
-        "Content-Length": str(req_length),
-        "Content-Disposition": f'{disposition}; filename="{file_name}"',
-        "Accept-Ranges": "bytes",
-        "Cache-Control": "public, max-age=86400",  # 24 hours cache
-        "ETag": f'"{db_id}-{file_size}"',
-        "Connection": "keep-alive",
-    }
-    body = tg_connect.yield_file(
-        file_id, index, offset, first_part_cut, last_part_cut, part_count, chunk_size
-    )
-
-    mime_type = file_id.mime_type
-    file_name = utils.get_name(file_id)
-    disposition = "attachment"
+        if Telegram.MULTI_CLIENT and Server.STRIPE_CLIENTS > 1 and req_length >= Server.STRIPE_MIN_SIZE:
+            stripes = await get_stripes(db_id, index, tg_connect, file_id)
+            slots += [AdmissionSlot(stripe_index) for stripe_index, _, _ in stripes[1:]]
 
-    if not mime_type:
-        mime_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+        if len(stripes) > 1:
+            logging.debug(f"Striping download of {db_id} across clients {[s[0] for s in stripes]}")
+            body = utils.yield_file_striped(stripes, from_bytes, until_bytes, db_id, slots)
+        else:
+            body = tg_connect.yield_file(file_id, index, from_bytes, until_bytes, db_id, slot)
 
-    # if "video/" in mime_type or "audio/" in mime_type:
-    #     disposition = "inline"
+    try:
+        await response.prepare(request)
+        try:
+            if not await write_body(request, response, body):
+                return response
+        except Exception as e:
+            # The status line and headers are out, the only way left to signal the failure is to drop the connection
+            logging.error(f"Stream of {db_id} failed after the response started: {type(e).__name__}: {e}")
+            if request.transport is not None:
+                request.transport.close()
+            return response
+        await response.write_eof()
+    finally:
+        await body.aclose()
+        for stripe_slot in slots[1:]:
+            await admission.release(stripe_slot.index)
+    return response
 
-    return web.Response(
-        status=206 if range_header else 200,
-        body=body,
-        headers=headers,
-    )
+async def write_body(request: web.Request, response: web.StreamResponse, body) -> bool:
+    """
+    Writes the chunks of `body` as they arrive. Each write waits for the transport to drain
+    once its buffer is full, so upstream prefetching is paced by the client.
+    Returns False when the client went away, the caller then closes `body`, which cancels
+    the fetches still in flight instead of reading the rest of the range.
+    Raises EOFError when the body ends before Content-Length.
+    """
+    written = 0
+    try:
+        async for chunk in body:
+            transport = request.transport
+            if transport is None or transport.is_closing():
+                raise ConnectionResetError("Client disconnected")
+            await response.write(chunk)
+            written += len(chunk)
+    except ConnectionResetError:
+        logging.debug(f"Client {request.remote} disconnected after {written} bytes")
+        return False
+    if response.content_length is not None and written < response.content_length:
+        raise EOFError(f"Body ended after {written} of {response.content_length} bytes")
+    return True
 
 @routes.get("/health", allow_head=True)
 async def health_check(_):
@@ -188,7 +268,7 @@ async def cache_middleware(request, handler):
     # Add cache headers for static content
     if request.path.startswith(('/dl/', '/watch/')):
         response = await handler(request)
-        if response.status == 200:
+        if response.status == 200 and not response.prepared:
             response.headers['Cache-Control'] = 'public, max-age=86400'
             response.headers['X-Content-Type-Options'] = 'nosniff'
         return response
@@ -1,3 +1,3 @@
 from .time_format import get_readable_time
 from .file_properties import get_name, get_file_ids
-from .custom_dl import ByteStreamer
\ No newline at end of file
+from .custom_dl import ByteStreamer, yield_file_striped
\ No newline at end of file
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Set
+from FileStream.bot import multi_clients, work_loads
+from FileStream.config import Server
+from FileStream.server.exceptions import ServerOverloaded
+from FileStream.utils.circuit_breaker import get_breaker
+
+class AdmissionSlot:
+    """
+    The admitted slot of one stream. It moves with the stream when the stream fails over,
+    so it is released on whichever client the stream ended on.
+    """
+    def __init__(self, index: int):
+        self.index = index
+
+
+class AdmissionController:
+    """
+    Caps the number of concurrent streams globally (MAX_STREAMS) and per client
+    (MAX_CLIENT_STREAMS). Requests over the caps wait in a short queue and are
+    turned away with ServerOverloaded when the queue is full or the wait times out.
+    """
+    def __init__(self):
+        self.active: Dict[int, int] = {}  # client index -> admitted streams
+        self.total = 0
+        self.waiting = 0
+        self.condition = asyncio.Condition()
+
+    def has_capacity(self, index: int) -> bool:
+        return not Server.MAX_CLIENT_STREAMS or self.active.get(index, 0) < Server.MAX_CLIENT_STREAMS
+
+    def available_clients(self) -> Set[int]:
+        if Server.MAX_STREAMS and self.total >= Server.MAX_STREAMS:
+            return set()
+        clients = {i for i in multi_clients if i in work_loads and self.has_capacity(i)}
+        # Skip clients whose circuit breaker is open, unless every client is quarantined
+        healthy = {i for i in clients if get_breaker(i).available()}
+        return healthy or clients
+
+    async def acquire(self, select: Callable[[Set[int]], Awaitable[int]]) -> int:
+        """
+        Waits for a free slot and returns the client picked by `select` among the clients with capacity.
+        """
+        loop = asyncio.get_running_loop()
+        async with self.condition:
+            available = self.available_clients()
+            if not available:
+                if self.waiting >= Server.STREAM_QUEUE_SIZE:
+                    logging.warning(f"Rejecting stream, {self.total} active and {self.waiting} queued")
+                    raise ServerOverloaded
+                self.waiting += 1
+                deadline = loop.time() + Server.STREAM_QUEUE_TIMEOUT
+                try:
+                    while not available:
+                        remaining = deadline - loop.time()
+                        if remaining <= 0:
+                            raise ServerOverloaded
+                        try:
+                            await asyncio.wait_for(self.condition.wait(), remaining)
+                        except asyncio.TimeoutError:
+                            raise ServerOverloaded
+                        available = self.available_clients()
+                finally:
+                    self.waiting -= 1
+            index = await select(available)
+            self.admit(index)
+            return index
+
+    def try_acquire(self, index: int) -> bool:
+        """Takes a slot on a specific client without waiting, for extra stripes of a download"""
+        if index not in self.available_clients():
+            return False
+        self.admit(index)
+        return True
+
+    def admit(self, index: int) -> None:
+        self.active[index] = self.active.get(index, 0) + 1
+        self.total += 1
+        get_breaker(index).on_admit()
+
+    async def transfer(self, old: int, new: int) -> None:
+        """Moves an admitted slot from client `old` to client `new`, waking a stream queued for `old`"""
+        async with self.condition:
+            self.active[old] = max(0, self.active.get(old, 0) - 1)
+            self.active[new] = self.active.get(new, 0) + 1
+            self.condition.notify()
+
+    async def release(self, index: int) -> None:
+        async with self.condition:
+            self.active[index] = max(0, self.active.get(index, 0) - 1)
+            self.total = max(0, self.total - 1)
+            self.condition.notify()
+
+    def status(self) -> dict:
+        return {
+            "active": self.total,
+            "queued": self.waiting,
+            "max_streams": Server.MAX_STREAMS,
+            "max_client_streams": Server.MAX_CLIENT_STREAMS,
+        }
+
+# Global instance
+admission = AdmissionController()
@@ -1,8 +1,8 @@
 import asyncio
 import logging
 import time
-from FileStream.utils.database import Database
-from FileStream.config import Telegram
+from FileStream.utils.database import Database, expiry_index
+from FileStream.config import Telegram, Server
 
 class BackgroundTasks:
     def __init__(self):
@@ -13,7 +13,9 @@ class BackgroundTasks:
     async def start_background_tasks(self):
         """Start all background tasks"""
         self.running = True
-        asyncio.create_task(self.file_cleanup_task())
+        if not Server.MONGO_TTL_EXPIRY:
+            asyncio.create_task(self.file_cleanup_task())
+        asyncio.create_task(self.expiry_task())
         asyncio.create_task(self.request_cleanup_task())
         logging.info("Background tasks started")
 
@@ -34,6 +36,17 @@ class BackgroundTasks:
             
             await asyncio.sleep(self.cleanup_interval)
 
+    async def expiry_task(self):
+        """Background task deleting the files of the expiry index as soon as they expire"""
+        while self.running:
+            for _id in expiry_index.due(time.time()):
+                try:
+                    if await self.db.delete_expired_file(_id):
+                        logging.debug(f"Deleted expired file {_id}")
+                except Exception as e:
+                    logging.error(f"Error deleting expired file {_id}: {e}")
+            await expiry_index.wait(self.cleanup_interval)
+
     async def request_cleanup_task(self):
         """Background task to clean up old active requests"""
         while self.running:
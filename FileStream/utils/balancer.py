@@ -0,0 +1,84 @@
+import logging
+from typing import Dict, Optional, Set
+from pyrogram.file_id import FileId
+from FileStream.bot import multi_clients, work_loads
+from FileStream.config import Server
+from FileStream.utils.custom_dl import class_cache
+from FileStream.utils.file_id_cache import file_id_cache
+from FileStream.utils.client_stats import get_client_stats, client_stats
+from FileStream.utils.circuit_breaker import get_breaker
+from FileStream.utils.file_properties import db
+
+client_dcs: Dict[int, int] = {}  # client index -> home DC
+
+async def get_home_dc(index: int) -> Optional[int]:
+    if index not in client_dcs:
+        try:
+            client_dcs[index] = await multi_clients[index].storage.dc_id()
+        except Exception as e:
+            logging.debug(f"Couldn't read home DC of client {index}: {e}")
+            return None
+    return client_dcs[index]
+
+async def get_file_dc(db_id: str) -> Optional[int]:
+    """
+    Returns the DC a file lives on, from any client's cached FileId or else from the stored file_id.
+    """
+    dc_id = file_id_cache.dc_id(db_id)
+    if dc_id is not None:
+        return dc_id
+    file_info = await db.get_file(db_id)
+    try:
+        return FileId.decode(file_info['file_id']).dc_id
+    except Exception as e:
+        logging.debug(f"Couldn't decode file_id of {db_id}: {e}")
+        return None
+
+async def has_dc_affinity(index: int, dc_id: int) -> bool:
+    """Whether the client can reach the DC without setting up an exported-auth session"""
+    if await get_home_dc(index) == dc_id:
+        return True
+    streamer = class_cache.get(multi_clients[index])
+    return bool(streamer and streamer.media_sessions.get(dc_id))
+
+def expected_time(index: int, dc_id: Optional[int]) -> float:
+    """
+    Estimated seconds for the client to deliver BALANCER_ESTIMATE_BYTES of a new stream:
+    its EWMA throughput on the DC shared with the streams it already serves, plus the rest
+    of any FloodWait and a penalty scaled by its error rate.
+    """
+    stats = get_client_stats(index)
+    known = [rate for s in client_stats.values() for rate in s.throughput.values()]
+    throughput = stats.throughput.get(dc_id) or (sum(known) / len(known) if known else Server.BALANCER_DEFAULT_THROUGHPUT)
+    estimate = Server.BALANCER_ESTIMATE_BYTES * (work_loads.get(index, 0) + 1) / max(throughput, 1.0)
+    estimate += stats.flood_remaining()
+    estimate += stats.error_rate * Server.BALANCER_ERROR_PENALTY
+    return estimate
+
+async def select_client(dc_id: Optional[int] = None, allowed: Optional[Set[int]] = None) -> int:
+    """
+    Picks a client for a stream from the file's DC, among `allowed` if given: clients with DC affinity
+    first, then the lowest expected completion time. Clients with an open circuit breaker are only
+    picked when no other is left.
+    """
+    candidates = [i for i in multi_clients if i in work_loads and (allowed is None or i in allowed)]
+    candidates = [i for i in candidates if get_breaker(i).available()] or candidates
+    keys = {}
+    for index in candidates:
+        affinity = dc_id is None or await has_dc_affinity(index, dc_id)
+        keys[index] = (not affinity, expected_time(index, dc_id), work_loads[index])
+    return min(candidates, key=keys.get)
+
+async def balancer_status() -> dict:
+    """Current scores and accumulated stats of every client, for /status"""
+    status = {}
+    for index in list(multi_clients):
+        stats = get_client_stats(index)
+        status[str(index)] = dict(
+            stats.to_dict(),
+            load=work_loads.get(index, 0),
+            home_dc=await get_home_dc(index),
+            score=round(expected_time(index, None), 3),
+            breaker=get_breaker(index).to_dict(),
+        )
+    return status
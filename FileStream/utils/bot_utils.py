@@ -92,9 +92,7 @@ async def gen_link(_id):
     remaining_seconds = int(expires_at - current_time)
     
     if remaining_seconds <= 0:
-        # File has expired
-        await db.delete_one_file(file_info['_id'])
-        await db.count_links(file_info['user_id'], "-")
+        # File has expired, the expiry task deletes it
         raise Exception("File has expired")
     
     # Format remaining time
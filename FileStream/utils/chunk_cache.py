@@ -0,0 +1,181 @@
+import os
+import asyncio
+import logging
+import tempfile
+from collections import OrderedDict
+from typing import Optional, Set
+from FileStream.config import Server
+
+class MemoryChunkCache:
+    """
+    Process-wide in-memory cache of recently fetched chunks shared by every ByteStreamer.
+    Bounded by the total size of the cached chunks, least recently used evicted first.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size  # Size budget in bytes, 0 disables the cache
+        self.entries: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self.current_size = 0
+
+    def get(self, unique_id: str, chunk_size: int, index: int) -> Optional[bytes]:
+        """Returns the cached chunk or None on a miss"""
+        key = (unique_id, chunk_size, index)
+        chunk = self.entries.get(key)
+        if chunk is not None:
+            self.entries.move_to_end(key)
+        return chunk
+
+    def put(self, unique_id: str, chunk_size: int, index: int, data: bytes) -> None:
+        """Stores a chunk and evicts the least recently used ones past the budget"""
+        if not unique_id or not data or len(data) > self.max_size:
+            return
+        key = (unique_id, chunk_size, index)
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.current_size -= len(old)
+        self.entries[key] = data
+        self.current_size += len(data)
+        while self.current_size > self.max_size:
+            _, evicted = self.entries.popitem(last=False)
+            self.current_size -= len(evicted)
+
+
+class DiskChunkCache:
+    """
+    On-disk cache of streamed chunks, keyed by file_unique_id and chunk index.
+    Entries are evicted least recently used first once the size budget is exceeded.
+    """
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size  # Size budget in bytes, 0 disables the cache
+        self.entries: "OrderedDict[str, int]" = OrderedDict()  # path -> size, oldest first
+        self.writing: Set[str] = set()  # Paths being written
+        self.current_size = 0
+        self.loaded = False
+        self.load_lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def chunk_path(self, unique_id: str, chunk_size: int, index: int) -> str:
+        return os.path.join(self.directory, unique_id, f"{chunk_size}-{index}.chunk")
+
+    async def get(self, unique_id: str, chunk_size: int, index: int) -> Optional[bytes]:
+        """Returns the cached chunk or None on a miss"""
+        if not self.enabled or not unique_id:
+            return None
+        await self.load()
+        path = self.chunk_path(unique_id, chunk_size, index)
+        if path not in self.entries:
+            return None
+        self.entries.move_to_end(path)
+        try:
+            return await asyncio.to_thread(self.read_chunk, path)
+        except OSError as e:
+            logging.warning(f"Dropping unreadable cached chunk {path}: {e}")
+            self.forget(path)
+            return None
+
+    async def put(self, unique_id: str, chunk_size: int, index: int, data: bytes) -> None:
+        """Stores a chunk and evicts the least recently used ones past the budget"""
+        if not self.enabled or not unique_id or not data or len(data) > self.max_size:
+            return
+        await self.load()
+        path = self.chunk_path(unique_id, chunk_size, index)
+        if path in self.entries:
+            self.entries.move_to_end(path)
+            return
+        if path in self.writing:
+            return
+        # Reserved while the write runs so a concurrent put of the same chunk doesn't count it twice
+        self.writing.add(path)
+        try:
+            await asyncio.to_thread(self.write_chunk, path, data)
+        except OSError as e:
+            logging.warning(f"Failed to cache chunk {path}: {e}")
+            return
+        finally:
+            self.writing.discard(path)
+        self.entries[path] = len(data)
+        self.current_size += len(data)
+
+        evicted = []
+        while self.current_size > self.max_size and self.entries:
+            old_path, size = self.entries.popitem(last=False)
+            self.current_size -= size
+            evicted.append(old_path)
+        if evicted:
+            await asyncio.to_thread(self.remove_chunks, evicted)
+
+    def forget(self, path: str) -> None:
+        size = self.entries.pop(path, None)
+        if size is not None:
+            self.current_size -= size
+
+    async def load(self) -> None:
+        """Rebuilds the index from the cache directory on first use"""
+        if self.loaded:
+            return
+        async with self.load_lock:
+            if self.loaded:
+                return
+            entries = await asyncio.to_thread(self.scan_directory)
+            for path, size in entries:
+                self.entries[path] = size
+                self.current_size += size
+            self.loaded = True
+            logging.info(f"Chunk cache loaded {len(self.entries)} chunks ({self.current_size} bytes) from {self.directory}")
+
+    def scan_directory(self) -> list:
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if not name.endswith(".chunk"):
+                        # Leftover of a write interrupted by a crash
+                        os.remove(path)
+                        continue
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found.append((stat.st_atime, path, stat.st_size))
+        found.sort()
+        return [(path, size) for _, path, size in found]
+
+    @staticmethod
+    def read_chunk(path: str) -> bytes:
+        # A plain read in the worker thread: a mapping would only defer the disk reads to page faults on the event loop
+        with open(path, "rb") as f:
+            return f.read()
+
+    @staticmethod
+    def write_chunk(path: str, data: bytes) -> None:
+        # Write to a temporary file first so a crash never leaves a truncated chunk behind.
+        # No fsync: a cache can lose chunks, and the rename alone keeps readers from seeing partial ones
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    @staticmethod
+    def remove_chunks(paths: list) -> None:
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+# Global instances
+memory_cache = MemoryChunkCache(Server.MEMORY_CACHE_SIZE)
+disk_cache = DiskChunkCache(Server.CHUNK_CACHE_DIR, Server.CHUNK_CACHE_SIZE)
@@ -0,0 +1,95 @@
+import time
+import logging
+from collections import deque
+from typing import Dict
+from pyrogram.errors import BadRequest, FloodWait, Unauthorized
+from FileStream.config import Server
+
+class CircuitBreaker:
+    """
+    Takes an unhealthy client out of rotation.
+    Trips open on a FloodWait (for its duration), an auth error, or when at least
+    BREAKER_MIN_FAILURES of the last BREAKER_WINDOW upstream requests failed and the
+    failure ratio reached BREAKER_ERROR_RATE. Once the cooldown is over it goes half-open
+    and lets a single probe stream through: a successful request made for the probe closes it
+    again, a failed one re-opens it with a doubled cooldown. Requests still in flight from
+    before the trip can't close it.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, index: int):
+        self.index = index
+        self.state = self.CLOSED
+        self.results = deque(maxlen=Server.BREAKER_WINDOW)  # True for failed requests
+        self.open_until = 0.0
+        self.cooldown = Server.BREAKER_COOLDOWN
+        self.probe_started = 0.0
+        self.trips = 0
+        self.last_error = None
+
+    def available(self) -> bool:
+        """Whether the client may take a new stream"""
+        now = time.time()
+        if self.state == self.OPEN and now >= self.open_until:
+            self.state = self.HALF_OPEN
+            self.probe_started = 0.0
+            logging.info(f"Circuit breaker of client {self.index} is half-open")
+        if self.state == self.HALF_OPEN:
+            return now - self.probe_started >= Server.BREAKER_PROBE_TIMEOUT
+        return self.state == self.CLOSED
+
+    def on_admit(self) -> None:
+        if self.state == self.HALF_OPEN:
+            self.probe_started = time.time()
+
+    def record_success(self, requested_at: float) -> None:
+        """Records a request sent at `requested_at` (wall clock) that succeeded"""
+        self.results.append(False)
+        if self.state == self.HALF_OPEN and self.probe_started and requested_at >= self.probe_started:
+            logging.info(f"Circuit breaker of client {self.index} closed")
+            self.state = self.CLOSED
+            self.cooldown = Server.BREAKER_COOLDOWN
+            self.results.clear()
+
+    def record_failure(self, error: Exception) -> None:
+        if isinstance(error, BadRequest):
+            return  # Bad requests, like expired file references, say nothing about the client
+        self.results.append(True)
+        self.last_error = f"{type(error).__name__}: {error}"
+        if isinstance(error, FloodWait):
+            self.trip(max(error.value, 1))
+        elif isinstance(error, Unauthorized):
+            self.trip(Server.BREAKER_AUTH_COOLDOWN)
+        elif self.state == self.HALF_OPEN:
+            self.cooldown = min(self.cooldown * 2, Server.BREAKER_MAX_COOLDOWN)
+            self.trip(self.cooldown)
+        elif self.state == self.CLOSED:
+            failures = sum(self.results)
+            if failures >= Server.BREAKER_MIN_FAILURES and failures / len(self.results) >= Server.BREAKER_ERROR_RATE:
+                self.trip(self.cooldown)
+
+    def trip(self, duration: float) -> None:
+        self.open_until = max(self.open_until, time.time() + duration)
+        if self.state != self.OPEN:
+            self.trips += 1
+            logging.warning(f"Circuit breaker of client {self.index} opened for {int(duration)}s: {self.last_error}")
+        self.state = self.OPEN
+
+    def to_dict(self) -> dict:
+        self.available()
+        return {
+            "state": self.state,
+            "open_for": int(max(0.0, self.open_until - time.time())) if self.state == self.OPEN else 0,
+            "recent_failures": sum(self.results),
+            "trips": self.trips,
+            "last_error": self.last_error,
+        }
+
+breakers: Dict[int, CircuitBreaker] = {}  # client index -> breaker
+
+def get_breaker(index: int) -> CircuitBreaker:
+    if index not in breakers:
+        breakers[index] = CircuitBreaker(index)
+    return breakers[index]
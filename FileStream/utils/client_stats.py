@@ -0,0 +1,56 @@
+import time
+from typing import Dict
+from pyrogram.errors import FloodWait
+
+class ClientStats:
+    """
+    Health of one client as seen by the streams it serves: EWMA throughput per DC,
+    EWMA error rate and the end of its latest FloodWait.
+    """
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.throughput: Dict[int, float] = {}  # dc_id -> EWMA bytes per second of upstream chunks
+        self.error_rate = 0.0  # EWMA of failed upstream requests
+        self.flood_until = 0.0  # time.time() at which the latest FloodWait ends
+        self.bytes_served = 0
+        self.requests = 0
+        self.errors = 0
+        self.flood_waits = 0
+
+    def record_chunk(self, dc_id: int, size: int, elapsed: float) -> None:
+        self.requests += 1
+        self.bytes_served += size
+        self.error_rate *= 1 - self.alpha
+        if size and elapsed > 0:
+            rate = size / elapsed
+            previous = self.throughput.get(dc_id)
+            self.throughput[dc_id] = rate if previous is None else previous + self.alpha * (rate - previous)
+
+    def record_error(self, error: Exception) -> None:
+        self.requests += 1
+        self.errors += 1
+        self.error_rate += self.alpha * (1 - self.error_rate)
+        if isinstance(error, FloodWait):
+            self.flood_waits += 1
+            self.flood_until = max(self.flood_until, time.time() + error.value)
+
+    def flood_remaining(self) -> float:
+        return max(0.0, self.flood_until - time.time())
+
+    def to_dict(self) -> dict:
+        return {
+            "throughput": {str(dc_id): int(rate) for dc_id, rate in self.throughput.items()},
+            "error_rate": round(self.error_rate, 3),
+            "flood_wait_remaining": int(self.flood_remaining()),
+            "bytes_served": self.bytes_served,
+            "requests": self.requests,
+            "errors": self.errors,
+            "flood_waits": self.flood_waits,
+        }
+
+client_stats: Dict[int, ClientStats] = {}  # client index -> stats
+
+def get_client_stats(index: int) -> ClientStats:
+    if index not in client_stats:
+        client_stats[index] = ClientStats()
+    return client_stats[index]
@@ -0,0 +1,45 @@
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Mapping, Optional
+
+def http_date(timestamp: float) -> str:
+    return formatdate(timestamp, usegmt=True)
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """Weak comparison of an If-None-Match list against our entity tag"""
+    if header.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+def is_not_modified(headers: Mapping[str, str], method: str, etag: str, last_modified: Optional[float] = None) -> bool:
+    """
+    Whether a GET/HEAD request can be answered with 304 Not Modified (RFC 7232).
+    If-None-Match takes precedence, If-Modified-Since is only looked at without it.
+    """
+    if method not in ("GET", "HEAD"):
+        return False
+    if_none_match = headers.get("If-None-Match")
+    if if_none_match:
+        return etag_matches(if_none_match, etag)
+    if_modified_since = headers.get("If-Modified-Since")
+    if if_modified_since and last_modified is not None:
+        try:
+            return int(last_modified) <= int(parsedate_to_datetime(if_modified_since).timestamp())
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def validator_headers(etag: str, last_modified: Optional[float] = None) -> dict:
+    headers = {"ETag": etag}
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+    return headers
@@ -1,21 +1,52 @@
+import time
+import random
 import asyncio
 import logging
-from typing import Dict, Union
-from FileStream.bot import work_loads
+from hashlib import sha256
+from collections import OrderedDict, deque
+from typing import AsyncGenerator, Awaitable, Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
+from FileStream.bot import work_loads, multi_clients
+from FileStream.config import Server
 from pyrogram import Client, utils, raw
-from .file_properties import get_file_ids
+from .file_properties import get_file_ids, refresh_file_id
+from .chunk_cache import disk_cache, memory_cache
+from .client_stats import get_client_stats
+from .file_id_cache import file_id_cache
+from .circuit_breaker import get_breaker
+from .admission import AdmissionSlot, admission
 from pyrogram.session import Session, Auth
-from pyrogram.errors import AuthBytesInvalid
+from pyrogram.crypto import aes
+from pyrogram.errors import AuthBytesInvalid, FloodWait, FileReferenceExpired, FileReferenceInvalid, CDNFileHashMismatch, RPCError
 from pyrogram.file_id import FileId, FileType, ThumbnailSource
 from pyrogram.types import Message
 
+inflight_fetches: Dict[tuple, Tuple[asyncio.Future, Optional[int]]] = {}  # Upstream fetches shared by concurrent streams -> (fetch, client index)
+CLIENT_ERRORS = (FloodWait, TimeoutError, ConnectionError, FileReferenceExpired, FileReferenceInvalid)  # Say nothing about other clients
+cache_writes: Set[asyncio.Future] = set()  # Pending disk cache writes
+class_cache = {}  # One ByteStreamer per client
+PRODUCTION_DCS = (1, 2, 3, 4, 5)
+CDN_HASH_PIECE = 128 * 1024  # Size of the pieces CDN file hashes are computed over
+GETFILE_MIN_LIMIT = 4 * 1024  # GetFile limits must be powers of two between these
+GETFILE_MAX_LIMIT = 1024 * 1024
+CDN_REUPLOAD_ATTEMPTS = 3  # Reuploads asked for one CDN chunk before falling back to the main DC
+
 class ByteStreamer:
-    def __init__(self, client: Client):
-        self.clean_timer = 15 * 60  # Reduced to 15 minutes for better memory management
+    def __init__(self, client: Client, index: Optional[int] = None):
         self.client: Client = client
-        self.cached_file_ids: Dict[str, FileId] = {}
-        self.max_cache_size = 100  # Limit cache size
-        asyncio.create_task(self.clean_cache())
+        self.index = index  # Key of the client in multi_clients, used for its health stats
+        self.prefetch_parts = Server.PREFETCH_PARTS
+        self.prefetch_bytes = Server.PREFETCH_BYTES
+        self.sessions_per_dc = max(1, Server.MEDIA_SESSIONS_PER_DC)
+        self.media_sessions: Dict[int, List[Session]] = {}  # dc_id -> pooled media sessions
+        self.session_loads: Dict[Session, int] = {}  # Requests in flight per media session
+        self.session_creations: Dict[int, asyncio.Future] = {}  # dc_id -> media session being created
+        self.session_failures: Dict[int, int] = {}  # dc_id -> consecutive failed creations
+        self.session_retry_at: Dict[int, float] = {}  # dc_id -> monotonic time creation may be retried
+        self.session_errors: Dict[int, Exception] = {}  # dc_id -> error of the last failed creation
+        self.cdn_redirects: "OrderedDict[tuple, CdnRedirect]" = OrderedDict()  # (media id, thumb size) -> CDN location
+        self.cdn_sessions: Dict[int, asyncio.Future] = {}  # CDN dc_id -> session
+        self.file_refreshes: Dict[str, asyncio.Future] = {}  # db_id -> file reference being refreshed
+        self.keep_warm_task = None
 
     async def get_file_properties(self, db_id: str, multi_clients) -> FileId:
         """
@@ -23,18 +54,12 @@ class ByteStreamer:
         if the properties are cached, then it'll return the cached results.
         or it'll generate the properties from the Message ID and cache them.
         """
-        if db_id not in self.cached_file_ids:
-            # Cache size management
-            if len(self.cached_file_ids) >= self.max_cache_size:
-                # Remove oldest entries (simple FIFO)
-                for _ in range(10):  # Remove 10 oldest entries
-                    if self.cached_file_ids:
-                        self.cached_file_ids.pop(next(iter(self.cached_file_ids)))
-            
+        file_id = file_id_cache.get(self.index, db_id)
+        if file_id is None:
             logging.debug("Before Calling generate_file_properties")
-            await self.generate_file_properties(db_id, multi_clients)
+            file_id = await self.generate_file_properties(db_id, multi_clients)
             logging.debug(f"Cached file properties for file with ID {db_id}")
-        return self.cached_file_ids[db_id]
+        return file_id
     
     async def generate_file_properties(self, db_id: str, multi_clients) -> FileId:
         """
@@ -44,64 +69,189 @@ class ByteStreamer:
         logging.debug("Before calling get_file_ids")
         file_id = await get_file_ids(self.client, db_id, multi_clients, Message)
         logging.debug(f"Generated file ID and Unique ID for file with ID {db_id}")
-        self.cached_file_ids[db_id] = file_id
+        file_id_cache.put(self.index, db_id, file_id)
         logging.debug(f"Cached media file with ID {db_id}")
-        return self.cached_file_ids[db_id]
+        return file_id
+
+    async def refresh_file_properties(self, db_id: str, stale_file_id: FileId) -> FileId:
+        """
+        Replaces a FileId whose file_reference expired with a fresh one read from the log channel.
+        Streams that hit the same expired reference share one refresh.
+        """
+        cached = file_id_cache.get(self.index, db_id)
+        if cached is not None and cached is not stale_file_id:
+            return cached
+
+        refresh = self.file_refreshes.get(db_id)
+        if refresh is None:
+            logging.info(f"Refreshing file reference of {db_id} for client {self.client.id}")
+            refresh = asyncio.ensure_future(refresh_file_id(self.client, db_id, multi_clients))
+            self.file_refreshes[db_id] = refresh
+            refresh.add_done_callback(lambda _: self.file_refreshes.pop(db_id, None))
+        file_id = await asyncio.shield(refresh)
+        file_id_cache.put(self.index, db_id, file_id)
+        return file_id
 
     async def generate_media_session(self, client: Client, file_id: FileId) -> Session:
         """
-        Generates the media session for the DC that contains the media file.
+        Returns the least busy media session for the DC that contains the media file.
+        Up to MEDIA_SESSIONS_PER_DC sessions are opened per DC, a new one only when all are busy.
         This is required for getting the bytes from Telegram servers.
         """
+        return await self.get_media_session(file_id.dc_id)
 
-        media_session = client.media_sessions.get(file_id.dc_id, None)
+    async def get_media_session(self, dc_id: int) -> Session:
+        sessions = self.media_sessions.setdefault(dc_id, [])
+        creation = self.session_creations.get(dc_id)
+        if sessions:
+            media_session = min(sessions, key=self.session_loads.get)
+            if (self.session_loads[media_session] == 0 or len(sessions) >= self.sessions_per_dc
+                    or creation is not None or time.monotonic() < self.session_retry_at.get(dc_id, 0)):
+                logging.debug(f"Using cached media session for DC {dc_id}")
+                return media_session
 
-        if media_session is None:
-            if file_id.dc_id != await client.storage.dc_id():
-                media_session = Session(
-                    client,
-                    file_id.dc_id,
-                    await Auth(
-                        client, file_id.dc_id, await client.storage.test_mode()
-                    ).create(),
-                    await client.storage.test_mode(),
-                    is_media=True,
-                )
-                await media_session.start()
+        if creation is None:
+            delay = self.session_retry_at.get(dc_id, 0) - time.monotonic()
+            if delay > 0:
+                # Fail fast so the stream can move to another client instead of waiting out the backoff
+                logging.debug(f"Media session for DC {dc_id} can't be retried for another {delay:.1f}s")
+                error = self.session_errors.get(dc_id)
+                if isinstance(error, FloodWait) or error is None:
+                    raise FloodWait(value=int(delay) + 1)
+                # A fresh instance per caller, re-raising the stored one would grow its traceback on every stream
+                try:
+                    retry_error = type(error)(value=error.value) if isinstance(error, RPCError) else type(error)(*error.args)
+                except Exception:
+                    retry_error = ConnectionError(f"Media session for DC {dc_id} is unavailable: {error}")
+                raise retry_error from error
+            # Concurrent callers share this task instead of each authorizing their own session
+            creation = asyncio.ensure_future(self.add_media_session(dc_id))
+            self.session_creations[dc_id] = creation
+            creation.add_done_callback(lambda _: self.session_creations.pop(dc_id, None))
+        return await asyncio.shield(creation)
 
-                for _ in range(6):
-                    exported_auth = await client.invoke(
-                        raw.functions.auth.ExportAuthorization(dc_id=file_id.dc_id)
-                    )
+    async def add_media_session(self, dc_id: int) -> Session:
+        """
+        Creates a media session and adds it to the pool, backing off after failures.
+        """
+        try:
+            media_session = await self.create_media_session(self.client, dc_id)
+        except Exception as e:
+            failures = self.session_failures.get(dc_id, 0) + 1
+            self.session_failures[dc_id] = failures
+            delay = e.value if isinstance(e, FloodWait) else min(
+                Server.SESSION_RETRY_BACKOFF * 2 ** (failures - 1), Server.SESSION_RETRY_MAX_BACKOFF
+            )
+            self.session_retry_at[dc_id] = time.monotonic() + delay
+            self.session_errors[dc_id] = e
+            logging.warning(f"Failed to create media session for DC {dc_id} ({failures} in a row), retrying in {delay}s: {e}")
+            raise
+
+        self.session_failures.pop(dc_id, None)
+        self.session_retry_at.pop(dc_id, None)
+        self.session_errors.pop(dc_id, None)
+        sessions = self.media_sessions.setdefault(dc_id, [])
+        sessions.append(media_session)
+        self.session_loads[media_session] = 0
+        self.client.media_sessions.setdefault(dc_id, media_session)
+        logging.debug(f"Media session pool for DC {dc_id} now has {len(sessions)} sessions")
+        return media_session
 
+    async def warm_media_sessions(self) -> None:
+        """
+        Opens a media session to every production DC in the background and keeps them alive,
+        so the first download from a foreign DC doesn't pay for the auth export/import.
+        """
+        if self.keep_warm_task is None:
+            self.keep_warm_task = asyncio.create_task(self.keep_warm())
+
+    async def keep_warm(self) -> None:
+        while True:
+            for dc_id in PRODUCTION_DCS:
+                for media_session in list(self.media_sessions.get(dc_id, [])):
+                    await self.check_media_session(dc_id, media_session)
+                if not self.media_sessions.get(dc_id):
                     try:
-                        await media_session.invoke(
-                            raw.functions.auth.ImportAuthorization(
-                                id=exported_auth.id, bytes=exported_auth.bytes
-                            )
-                        )
-                        break
-                    except AuthBytesInvalid:
-                        logging.debug(
-                            f"Invalid authorization bytes for DC {file_id.dc_id}"
+                        await self.get_media_session(dc_id)
+                    except Exception as e:
+                        logging.warning(f"Failed to warm media session for DC {dc_id}: {e}")
+            await asyncio.sleep(Server.SESSION_PING_INTERVAL)
+
+    async def check_media_session(self, dc_id: int, media_session: Session) -> None:
+        """
+        Pings a pooled media session and replaces it if it doesn't answer.
+        """
+        try:
+            await asyncio.wait_for(
+                media_session.invoke(raw.functions.Ping(ping_id=random.getrandbits(63))),
+                timeout=Server.SESSION_PING_TIMEOUT,
+            )
+            return
+        except Exception as e:
+            logging.warning(f"Media session for DC {dc_id} failed health check, rebuilding it: {e}")
+
+        sessions = self.media_sessions.get(dc_id, [])
+        if media_session in sessions:
+            sessions.remove(media_session)
+        self.session_loads.pop(media_session, None)
+        if self.client.media_sessions.get(dc_id) is media_session:
+            self.client.media_sessions.pop(dc_id)
+        try:
+            await media_session.stop()
+        except Exception:
+            pass
+        try:
+            await self.get_media_session(dc_id)
+        except Exception as e:
+            logging.warning(f"Failed to rebuild media session for DC {dc_id}: {e}")
+
+    @staticmethod
+    async def create_media_session(client: Client, dc_id: int) -> Session:
+        """
+        Opens and authorizes a new media session to the given DC.
+        """
+        if dc_id != await client.storage.dc_id():
+            media_session = Session(
+                client,
+                dc_id,
+                await Auth(
+                    client, dc_id, await client.storage.test_mode()
+                ).create(),
+                await client.storage.test_mode(),
+                is_media=True,
+            )
+            await media_session.start()
+
+            for _ in range(6):
+                exported_auth = await client.invoke(
+                    raw.functions.auth.ExportAuthorization(dc_id=dc_id)
+                )
+
+                try:
+                    await media_session.invoke(
+                        raw.functions.auth.ImportAuthorization(
+                            id=exported_auth.id, bytes=exported_auth.bytes
                         )
-                        continue
-                else:
-                    await media_session.stop()
-                    raise AuthBytesInvalid
+                    )
+                    break
+                except AuthBytesInvalid:
+                    logging.debug(
+                        f"Invalid authorization bytes for DC {dc_id}"
+                    )
+                    continue
             else:
-                media_session = Session(
-                    client,
-                    file_id.dc_id,
-                    await client.storage.auth_key(),
-                    await client.storage.test_mode(),
-                    is_media=True,
-                )
-                await media_session.start()
-            logging.debug(f"Created media session for DC {file_id.dc_id}")
-            client.media_sessions[file_id.dc_id] = media_session
+                await media_session.stop()
+                raise AuthBytesInvalid
         else:
-            logging.debug(f"Using cached media session for DC {file_id.dc_id}")
+            media_session = Session(
+                client,
+                dc_id,
+                await client.storage.auth_key(),
+                await client.storage.test_mode(),
+                is_media=True,
+            )
+            await media_session.start()
+        logging.debug(f"Created media session for DC {dc_id}")
         return media_session
 
 
@@ -154,69 +304,559 @@ class ByteStreamer:
         self,
         file_id: FileId,
         index: int,
-        offset: int,
-        first_part_cut: int,
-        last_part_cut: int,
-        part_count: int,
-        chunk_size: int,
+        from_bytes: int,
+        until_bytes: int,
+        db_id: str,
+        slot: Optional[AdmissionSlot] = None,
     ) -> Union[str, None]:
         """
         Custom generator that yields the bytes of the media file.
         Modded from <https://github.com/eyaadh/megadlbot_oss/blob/master/mega/telegram/utils/custom_download.py#L20>
         Thanks to Eyaadh <https://github.com/eyaadh>
         """
-        client = self.client
-        work_loads[index] += 1
+        source = StreamSource(self, index, db_id, file_id, slot)
         logging.debug(f"Starting to yielding file with client {index}.")
-        media_session = await self.generate_media_session(client, file_id)
-
         current_part = 1
 
-        location = await self.get_location(file_id)
+        try:
+            async for chunk in yield_parts(
+                [source.fetch], ChunkPlanner(from_bytes, until_bytes), self.prefetch_parts, self.prefetch_bytes
+            ):
+                yield chunk
+                current_part += 1
+        finally:
+            logging.debug(f"Finished yielding file with {current_part} parts.")
+            source.close()
+
+    async def fetch_chunk(self, file_id: FileId, location, offset: int, chunk_size: int) -> Union[bytes, memoryview]:
+        """
+        Returns a chunk of the media file from the memory or disk chunk cache,
+        fetching and caching it on a miss. Concurrent misses for the same chunk share one fetch.
+        """
+        unique_id = getattr(file_id, "unique_id", None)
+        index = offset // chunk_size
+        chunk = memory_cache.get(unique_id, chunk_size, index)
+        if chunk is not None:
+            return chunk
+        # A seek asks for small chunks, which may sit inside a bigger one cached by a sequential viewer
+        for size, block_index, start in enclosing_blocks(offset, chunk_size):
+            block = memory_cache.get(unique_id, size, block_index)
+            if block is not None:
+                return memoryview(block)[start:start + chunk_size]
 
+        key = (file_id.media_id, file_id.thumbnail_size, offset, chunk_size)
+        task, owner = inflight_fetches.get(key, (None, self.index))
+        if task is None:
+            task = asyncio.ensure_future(
+                self.load_chunk(file_id, location, offset, chunk_size)
+            )
+            inflight_fetches[key] = (task, owner)
+            task.add_done_callback(lambda _: inflight_fetches.pop(key, None))
+        else:
+            logging.debug(f"Joining in-flight fetch of {key} on client {owner}")
         try:
+            # Shielded so a viewer that disconnects doesn't cancel the fetch for the others
+            return await asyncio.shield(task)
+        except CLIENT_ERRORS as e:
+            if owner == self.index:
+                raise
+            # The fetch failed on the client that started it, ours may still be fine
+            logging.debug(f"Shared fetch of {key} failed on client {owner}, retrying on client {self.index}: {e}")
+            return await self.load_chunk(file_id, location, offset, chunk_size)
+
+    async def load_chunk(self, file_id: FileId, location, offset: int, chunk_size: int) -> Union[bytes, memoryview]:
+        """
+        Reads a chunk from the disk cache or Telegram and stores it in the memory cache.
+        Disk writes happen in the background so they don't delay the stream.
+        """
+        unique_id = getattr(file_id, "unique_id", None)
+        index = offset // chunk_size
+        chunk = await disk_cache.get(unique_id, chunk_size, index)
+        if chunk is None:
+            for size, block_index, start in enclosing_blocks(offset, chunk_size):
+                block = await disk_cache.get(unique_id, size, block_index)
+                if block is not None:
+                    memory_cache.put(unique_id, size, block_index, block)
+                    return memoryview(block)[start:start + chunk_size]
+            chunk = await self.request_chunk(file_id.dc_id, location, offset, chunk_size)
+            if len(cache_writes) < Server.CHUNK_CACHE_PENDING_WRITES:
+                write = asyncio.ensure_future(disk_cache.put(unique_id, chunk_size, index, chunk))
+                cache_writes.add(write)
+                write.add_done_callback(cache_writes.discard)
+            else:
+                # The disk is falling behind, skip the write rather than pile chunks up in memory
+                logging.debug(f"Not caching chunk {index} of {unique_id} on disk, {len(cache_writes)} writes pending")
+        memory_cache.put(unique_id, chunk_size, index, chunk)
+        return chunk
+
+    async def request_chunk(self, dc_id: int, location, offset: int, chunk_size: int) -> bytes:
+        """
+        Fetches a chunk from Telegram through the least busy media session. With HEDGE_REQUESTS on,
+        a chunk that takes longer than the DC's usual latency is requested again through another
+        pooled session and whichever answer arrives first is used.
+        """
+        try:
+            media_session = await self.get_media_session(dc_id)
+        except Exception as e:
+            # Auth export/import errors and FloodWaits on export count against the client too
+            self.record_failure(e)
+            raise
+        primary = asyncio.ensure_future(self.timed_get_chunk(dc_id, media_session, location, offset, chunk_size))
+        if not Server.HEDGE_REQUESTS:
+            return await primary
+
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_policy.delay(dc_id))
+            spare = self.spare_media_session(dc_id, media_session)
+            if done or spare is None or not hedge_policy.allow():
+                return await primary
+
+            logging.debug(f"Hedging chunk at offset {offset} on DC {dc_id}")
+            tasks.add(asyncio.ensure_future(self.timed_get_chunk(dc_id, spare, location, offset, chunk_size)))
+            while True:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    tasks.discard(task)
+                    if not task.exception() or not tasks:
+                        return task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def spare_media_session(self, dc_id: int, busy: Session) -> Optional[Session]:
+        """Least busy pooled session for the DC other than `busy`"""
+        others = [session for session in self.media_sessions.get(dc_id, []) if session is not busy]
+        return min(others, key=self.session_loads.get) if others else None
+
+    async def timed_get_chunk(self, dc_id: int, media_session: Session, location, offset: int, chunk_size: int) -> bytes:
+        self.session_loads[media_session] = self.session_loads.get(media_session, 0) + 1
+        started = time.monotonic()
+        requested_at = time.time()
+        try:
+            chunk = await self.get_chunk(media_session, location, offset, chunk_size)
+        except Exception as e:
+            self.record_failure(e)
+            raise
+        finally:
+            if media_session in self.session_loads:
+                self.session_loads[media_session] -= 1
+        elapsed = time.monotonic() - started
+        hedge_policy.record(dc_id, elapsed)
+        if self.index is not None:
+            get_client_stats(self.index).record_chunk(dc_id, len(chunk), elapsed)
+            get_breaker(self.index).record_success(requested_at)
+        return chunk
+
+    def record_failure(self, error: Exception) -> None:
+        if self.index is not None:
+            get_client_stats(self.index).record_error(error)
+            get_breaker(self.index).record_failure(error)
+
+    async def get_chunk(self, media_session: Session, location, offset: int, chunk_size: int) -> bytes:
+        """
+        Fetches a single chunk of the media file, returns empty bytes past the end of the file.
+        With CDN_DOWNLOADS on, files Telegram redirects to a CDN DC are read from there.
+        """
+        key = (getattr(location, "id", None), getattr(location, "thumb_size", None))
+        redirect = self.cdn_redirects.get(key)
+        if redirect is None:
             r = await media_session.invoke(
                 raw.functions.upload.GetFile(
-                    location=location, offset=offset, limit=chunk_size
+                    location=location, offset=offset, limit=chunk_size,
+                    cdn_supported=Server.CDN_DOWNLOADS
                 ),
             )
             if isinstance(r, raw.types.upload.File):
-                while True:
-                    chunk = r.bytes
-                    if not chunk:
-                        break
-                    elif part_count == 1:
-                        yield chunk[first_part_cut:last_part_cut]
-                    elif current_part == 1:
-                        yield chunk[first_part_cut:]
-                    elif current_part == part_count:
-                        yield chunk[:last_part_cut]
-                    else:
-                        yield chunk
-
-                    current_part += 1
-                    offset += chunk_size
-
-                    if current_part > part_count:
-                        break
-
-                    r = await media_session.invoke(
-                        raw.functions.upload.GetFile(
-                            location=location, offset=offset, limit=chunk_size
-                        ),
-                    )
-        except (TimeoutError, AttributeError):
-            pass
-        finally:
-            logging.debug(f"Finished yielding file with {current_part} parts.")
-            work_loads[index] -= 1
+                return r.bytes
+            if not isinstance(r, raw.types.upload.FileCdnRedirect):
+                return b""
+            redirect = CdnRedirect(r)
+            if key[0] is not None:
+                self.cdn_redirects[key] = redirect
+                while len(self.cdn_redirects) > 100:
+                    self.cdn_redirects.popitem(last=False)
+            logging.debug(f"File {key[0]} redirected to CDN DC {r.dc_id}")
+
+        try:
+            cdn_session = await self.get_cdn_session(redirect.dc_id)
+            return await fetch_cdn_chunk(media_session, cdn_session, redirect, offset, chunk_size)
+        except Exception as e:
+            # Fall back to the file's own DC if the CDN can't serve it
+            logging.warning(f"CDN DC {redirect.dc_id} failed at offset {offset}, reading from the main DC: {e}")
+            self.cdn_redirects.pop(key, None)
+            r = await media_session.invoke(
+                raw.functions.upload.GetFile(location=location, offset=offset, limit=chunk_size),
+            )
+            return r.bytes if isinstance(r, raw.types.upload.File) else b""
+
+    async def get_cdn_session(self, dc_id: int) -> Session:
+        """
+        Returns the session to a CDN DC, creating it once for concurrent callers.
+        """
+        creation = self.cdn_sessions.get(dc_id)
+        if creation is None:
+            creation = asyncio.ensure_future(self.create_cdn_session(self.client, dc_id))
+            self.cdn_sessions[dc_id] = creation
+
+            def forget_failed(task: asyncio.Future) -> None:
+                if task.cancelled() or task.exception() is not None:
+                    self.cdn_sessions.pop(dc_id, None)
+
+            creation.add_done_callback(forget_failed)
+        return await asyncio.shield(creation)
+
+    @staticmethod
+    async def create_cdn_session(client: Client, dc_id: int) -> Session:
+        test_mode = await client.storage.test_mode()
+        cdn_session = Session(
+            client,
+            dc_id,
+            await Auth(client, dc_id, test_mode).create(),
+            test_mode,
+            is_media=True,
+            is_cdn=True,
+        )
+        await cdn_session.start()
+        logging.debug(f"Created CDN session for DC {dc_id}")
+        return cdn_session
 
     
-    async def clean_cache(self) -> None:
+
+class StreamSource:
+    """
+    The client and FileId one stream reads its chunks from.
+    When Telegram reports the file_reference as expired, the FileId is refreshed.
+    When the client hits a FloodWait, a timeout or a dropped connection, the stream moves
+    to another client from multi_clients with that client's own FileId, taking its admission slot along.
+    Either way the chunk is fetched again from the same offset, so the response keeps going.
+    """
+    def __init__(self, streamer: ByteStreamer, index: int, db_id: str, file_id: FileId, slot: Optional[AdmissionSlot] = None):
+        self.streamer = streamer
+        self.index = index
+        self.db_id = db_id
+        self.file_id = file_id
+        self.slot = slot
+        self.failed_clients: Set[int] = set()
+        self.failover_lock = asyncio.Lock()
+        work_loads[index] += 1
+
+    def close(self) -> None:
+        work_loads[self.index] -= 1
+
+    async def fetch(self, offset: int, limit: int) -> bytes:
+        refreshed = False
+        while True:
+            streamer, file_id = self.streamer, self.file_id
+            try:
+                return await streamer.fetch_chunk(file_id, await streamer.get_location(file_id), offset, limit)
+            except (FileReferenceExpired, FileReferenceInvalid) as e:
+                if refreshed:
+                    raise
+                logging.warning(f"File reference of {self.db_id} rejected at offset {offset}: {e}")
+                if self.streamer is streamer:
+                    self.file_id = await streamer.refresh_file_properties(self.db_id, file_id)
+                refreshed = True
+            except (FloodWait, TimeoutError, ConnectionError) as e:
+                if not await self.failover(streamer, offset, e):
+                    raise
+
+    async def failover(self, failed: ByteStreamer, offset: int, error: Exception) -> bool:
         """
-        function to clean the cache to reduce memory usage
+        Switches the stream to the least loaded client that hasn't failed it yet,
+        trying quarantined clients last. Returns False when no other client can serve the file.
         """
+        async with self.failover_lock:
+            if self.streamer is not failed:
+                return True  # Another chunk of this stream already moved it
+            self.failed_clients.add(self.index)
+            candidates = sorted(
+                (i for i in multi_clients if i not in self.failed_clients and i in work_loads),
+                key=lambda i: (not get_breaker(i).available(), not admission.has_capacity(i), work_loads[i]),
+            )
+            for index in candidates:
+                try:
+                    streamer = get_byte_streamer(index)
+                    file_id = await streamer.get_file_properties(self.db_id, multi_clients)
+                except Exception as e:
+                    logging.warning(f"Client {index} can't take over stream of {self.db_id}: {e}")
+                    self.failed_clients.add(index)
+                    continue
+                logging.warning(
+                    f"Moving stream of {self.db_id} from client {self.index} to {index} at offset {offset}: "
+                    f"{type(error).__name__} {error}"
+                )
+                work_loads[self.index] -= 1
+                work_loads[index] += 1
+                if self.slot is not None:
+                    await admission.transfer(self.slot.index, index)
+                    self.slot.index = index
+                self.index, self.streamer, self.file_id = index, streamer, file_id
+                return True
+            logging.error(f"No client left to continue stream of {self.db_id} at offset {offset}")
+            return False
+
+
+class CdnRedirect:
+    """
+    Where and how to read a file Telegram moved to a CDN DC, plus the piece hashes seen so far.
+    """
+    def __init__(self, redirect: raw.types.upload.FileCdnRedirect):
+        self.dc_id = redirect.dc_id
+        self.file_token = redirect.file_token
+        self.encryption_key = redirect.encryption_key
+        self.encryption_iv = redirect.encryption_iv
+        self.hashes: Dict[int, raw.types.FileHash] = {h.offset: h for h in redirect.file_hashes}
+
+
+async def fetch_cdn_chunk(master_session, cdn_session, redirect: CdnRedirect, offset: int, limit: int) -> bytes:
+    """
+    Reads a chunk from a CDN DC, decrypts it (AES-256-CTR) and checks it against the piece hashes
+    served by the file's own DC. Only `invoke` is used on the sessions, so any object answering
+    the CDN requests can stand in for them.
+    <https://core.telegram.org/cdn>
+    """
+    # Hashes cover 128 KB pieces, smaller chunks are read as the whole piece and cut afterwards
+    start = offset - offset % CDN_HASH_PIECE if limit < CDN_HASH_PIECE else offset
+    length = max(limit, CDN_HASH_PIECE)
+
+    for attempt in range(CDN_REUPLOAD_ATTEMPTS + 1):
+        r = await cdn_session.invoke(
+            raw.functions.upload.GetCdnFile(file_token=redirect.file_token, offset=start, limit=length)
+        )
+        if not isinstance(r, raw.types.upload.CdnFileReuploadNeeded):
+            break
+        if attempt == CDN_REUPLOAD_ATTEMPTS:
+            raise ConnectionError(f"CDN DC {redirect.dc_id} still needs a reupload after {attempt} attempts")
+        for h in await master_session.invoke(
+            raw.functions.upload.ReuploadCdnFile(file_token=redirect.file_token, request_token=r.request_token)
+        ):
+            redirect.hashes[h.offset] = h
+
+    chunk = aes.ctr256_decrypt(
+        r.bytes,
+        redirect.encryption_key,
+        bytearray(redirect.encryption_iv[:-4] + (start // 16).to_bytes(4, "big")),
+    )
+
+    position = start
+    while position < start + len(chunk):
+        h = redirect.hashes.get(position)
+        if h is None:
+            for file_hash in await master_session.invoke(
+                raw.functions.upload.GetCdnFileHashes(file_token=redirect.file_token, offset=position)
+            ):
+                redirect.hashes[file_hash.offset] = file_hash
+            h = redirect.hashes.get(position)
+            if h is None:
+                raise CDNFileHashMismatch()
+        piece = chunk[position - start:position - start + h.limit]
+        if sha256(piece).digest() != h.hash:
+            raise CDNFileHashMismatch()
+        position += h.limit
+
+    return chunk[offset - start:offset - start + limit]
+
+
+class HedgePolicy:
+    """
+    Decides when a slow GetFile is duplicated.
+    Tracks recent latencies per DC and only allows HEDGE_BUDGET extra requests per request sent.
+    """
+    def __init__(self):
+        self.latencies: Dict[int, deque] = {}  # dc_id -> recent GetFile latencies in seconds
+        self.tokens = 0.0
+        self.max_tokens = 10.0
+
+    def record(self, dc_id: int, elapsed: float) -> None:
+        self.latencies.setdefault(dc_id, deque(maxlen=200)).append(elapsed)
+        self.tokens = min(self.max_tokens, self.tokens + Server.HEDGE_BUDGET)
+
+    def delay(self, dc_id: int) -> float:
+        """Seconds to wait for a chunk before hedging it"""
+        samples = sorted(self.latencies.get(dc_id, ()))
+        if len(samples) < 20:
+            return max(Server.HEDGE_MIN_DELAY, 2.0)
+        percentile = samples[min(len(samples) - 1, int(len(samples) * Server.HEDGE_PERCENTILE / 100))]
+        return max(Server.HEDGE_MIN_DELAY, percentile)
+
+    def allow(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def get_byte_streamer(index: int) -> ByteStreamer:
+    client = multi_clients[index]
+    if client in class_cache:
+        logging.debug(f"Using cached ByteStreamer object for client {index}")
+        return class_cache[client]
+    logging.debug(f"Creating new ByteStreamer object for client {index}")
+    tg_connect = ByteStreamer(client, index)
+    class_cache[client] = tg_connect
+    return tg_connect
+
+
+async def warm_media_sessions() -> None:
+    """Starts warming media sessions for every connected client"""
+    for index in list(multi_clients):
+        await get_byte_streamer(index).warm_media_sessions()
+    logging.info(f"Warming media sessions for {len(multi_clients)} clients")
+
+
+class ChunkPlanner:
+    """
+    Chooses the GetFile chunks for one response.
+    Chunk sizes are powers of two between MIN_CHUNK_SIZE and MAX_CHUNK_SIZE (clamped to the
+    4 KB - 1 MB GetFile accepts) and every chunk
+    starts at a multiple of its own size, which keeps Telegram's rules (offset and limit
+    divisible by 4 KB, 1 MB divisible by limit, no chunk crossing a 1 MB boundary).
+    Short ranges get a single small chunk, long ones start at START_CHUNK_SIZE and double
+    while chunks keep arriving faster than CHUNK_RAMP_LATENCY.
+    """
+    def __init__(self, from_bytes: int, until_bytes: int):
+        self.from_bytes = from_bytes
+        self.until_bytes = until_bytes
+        self.min_size = clamp_limit(floor_pow2(Server.MIN_CHUNK_SIZE))
+        self.max_size = max(self.min_size, clamp_limit(floor_pow2(Server.MAX_CHUNK_SIZE)))
+        self.ramp_latency = Server.CHUNK_RAMP_LATENCY
+
+        req_length = until_bytes - from_bytes + 1
+        start_size = min(ceil_pow2(req_length), floor_pow2(Server.START_CHUNK_SIZE))
+        self.chunk_size = min(max(start_size, self.min_size), self.max_size)
+        self.offset = from_bytes - from_bytes % self.chunk_size
+        self.first_offset = self.offset
+        self.fast = True  # Whether the last chunk arrived fast enough to grow
+
+    def next_chunk(self) -> Optional[Tuple[int, int]]:
+        """Returns the (offset, limit) of the next chunk, None once the range is covered"""
+        if self.offset > self.until_bytes:
+            return None
+        grown = self.chunk_size * 2
+        remaining = self.until_bytes + 1 - self.offset
+        if (self.fast and self.offset != self.first_offset and remaining > self.chunk_size
+                and grown <= self.max_size and self.offset % grown == 0):
+            self.chunk_size = grown
+        chunk = (self.offset, self.chunk_size)
+        self.offset += self.chunk_size
+        return chunk
+
+    def record(self, elapsed: float) -> None:
+        self.fast = elapsed < self.ramp_latency
+
+    def cut(self, chunk: bytes, offset: int) -> Union[bytes, memoryview]:
+        """Trims a chunk starting at `offset` to the requested range, without copying it"""
+        start = max(self.from_bytes - offset, 0)
+        end = min(self.until_bytes + 1 - offset, len(chunk))
+        if start == 0 and end == len(chunk):
+            return chunk
+        return memoryview(chunk)[start:end]
+
+
+def clamp_limit(size: int) -> int:
+    """Keeps a power of two chunk size within the limits GetFile accepts"""
+    return min(max(size, GETFILE_MIN_LIMIT), GETFILE_MAX_LIMIT)
+
+
+def enclosing_blocks(offset: int, chunk_size: int) -> Iterator[Tuple[int, int, int]]:
+    """
+    (size, index, start of the chunk within it) of every larger aligned chunk containing
+    the chunk at `offset`, so a chunk can be cut out of one cached at a bigger size.
+    """
+    size = chunk_size * 2
+    while size <= GETFILE_MAX_LIMIT:
+        yield size, offset // size, offset % size
+        size *= 2
+
+
+def floor_pow2(value: int) -> int:
+    return 1 << (max(value, 1).bit_length() - 1)
+
+
+def ceil_pow2(value: int) -> int:
+    return 1 << (max(value, 1) - 1).bit_length()
+
+
+async def yield_parts(
+    fetchers: List[Callable[[int, int], Awaitable[bytes]]],
+    planner: ChunkPlanner,
+    max_parts: int,
+    max_bytes: int,
+) -> AsyncGenerator[Union[bytes, memoryview], None]:
+    """
+    Yields the chunks chosen by the planner in order, keeping up to `max_parts` requests
+    in flight and no new ones once `max_bytes` are pending. Chunk n is fetched with fetchers[n % len(fetchers)],
+    so several clients can share one stream.
+    """
+    requested_parts = 0
+    inflight_bytes = 0
+    pending = deque()
+
+    async def timed_fetch(fetch, offset: int, limit: int) -> bytes:
+        started = time.monotonic()
+        chunk = await fetch(offset, limit)
+        planner.record(time.monotonic() - started)
+        return chunk
+
+    try:
         while True:
-            await asyncio.sleep(self.clean_timer)
-            self.cached_file_ids.clear()
-            logging.debug("Cleaned the cache")
+            while len(pending) < max(max_parts, 1) and (not pending or inflight_bytes < max_bytes):
+                next_chunk = planner.next_chunk()
+                if next_chunk is None:
+                    break
+                offset, limit = next_chunk
+                fetch = fetchers[requested_parts % len(fetchers)]
+                pending.append((offset, limit, asyncio.ensure_future(timed_fetch(fetch, offset, limit))))
+                inflight_bytes += limit
+                requested_parts += 1
+
+            if not pending:
+                break
+            offset, limit, task = pending.popleft()
+            inflight_bytes -= limit
+            chunk = await task
+            if not chunk:
+                break
+            yield planner.cut(chunk, offset)
+    finally:
+        tasks = [task for _, _, task in pending]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def yield_file_striped(
+    stripes: List[Tuple[int, ByteStreamer, FileId]],
+    from_bytes: int,
+    until_bytes: int,
+    db_id: str,
+    slots: Optional[List[AdmissionSlot]] = None,
+) -> AsyncGenerator[Union[bytes, memoryview], None]:
+    """
+    Same as ByteStreamer.yield_file, but the chunks are spread round-robin over several clients,
+    each one fetching with its own FileId and media session. `slots` are the stripes' admission slots.
+    """
+    slots = slots or [None] * len(stripes)
+    sources = [
+        StreamSource(streamer, index, db_id, file_id, slot)
+        for (index, streamer, file_id), slot in zip(stripes, slots)
+    ]
+    logging.debug(f"Starting to yield striped file with clients {[s[0] for s in stripes]}.")
+    current_part = 1
+    max_parts = sum(streamer.prefetch_parts for _, streamer, _ in stripes)
+    max_bytes = sum(streamer.prefetch_bytes for _, streamer, _ in stripes)
+
+    try:
+        async for chunk in yield_parts(
+            [source.fetch for source in sources], ChunkPlanner(from_bytes, until_bytes), max_parts, max_bytes
+        ):
+            yield chunk
+            current_part += 1
+    finally:
+        logging.debug(f"Finished yielding striped file with {current_part} parts.")
+        for source in sources:
+            source.close()
+
+# Global instance
+hedge_policy = HedgePolicy()
@@ -1,10 +1,146 @@
+import copy
+import heapq
+import asyncio
+import logging
 import pymongo
 import time
 import motor.motor_asyncio
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
 from bson.objectid import ObjectId
 from bson.errors import InvalidId
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from FileStream.config import Server
 from FileStream.server.exceptions import FIleNotFound
 
+class FileDocCache:
+    """
+    Process-wide cache in front of Database.get_file, shared by every Database instance.
+    Documents are kept for FILE_DOC_CACHE_TTL seconds and never past their own expires_at.
+    Ids without a document (deleted, expired and reaped, or never existing) go to a separate
+    negative cache bounded by FILE_DOC_NEGATIVE_SIZE, so dead links can't evict live documents.
+    Lookups hand out copies because callers modify the documents they get.
+    """
+    def __init__(self, max_size: int, ttl: int, negative_size: int, negative_ttl: int):
+        self.max_size = max_size  # Entries kept, 0 disables the cache
+        self.ttl = ttl
+        self.negative_size = negative_size
+        self.negative_ttl = negative_ttl
+        self.entries: "OrderedDict[str, Tuple[dict, float]]" = OrderedDict()  # _id -> (document, valid until)
+        self.negatives: "OrderedDict[str, float]" = OrderedDict()  # _id -> valid until
+        self.delete_listeners: List[Callable[[str], None]] = []  # Called with the _id of every deleted file
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def get(self, _id) -> Tuple[bool, Optional[dict]]:
+        """Returns (hit, document), the document being None for ids known to have none"""
+        key = str(_id)
+        now = time.time()
+        valid_until = self.negatives.get(key)
+        if valid_until is not None:
+            if now < valid_until:
+                self.negative_hits += 1
+                return True, None
+            del self.negatives[key]
+        entry = self.entries.get(key)
+        if entry is None or now >= entry[1]:
+            self.entries.pop(key, None)
+            self.misses += 1
+            return False, None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True, copy.deepcopy(entry[0])
+
+    def put(self, _id, file_info: Optional[dict]) -> None:
+        key = str(_id)
+        if file_info is None:
+            self.entries.pop(key, None)
+            if self.negative_size <= 0:
+                return
+            self.negatives[key] = time.time() + self.negative_ttl
+            self.negatives.move_to_end(key)
+            while len(self.negatives) > self.negative_size:
+                self.negatives.popitem(last=False)
+            return
+        if self.max_size <= 0:
+            return
+        self.negatives.pop(key, None)
+        valid_until = time.time() + self.ttl
+        expires_at = file_info.get("expires_at")
+        if expires_at is not None:
+            valid_until = min(valid_until, expires_at)
+        self.entries[key] = (copy.deepcopy(file_info), valid_until)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def forget(self, _id) -> None:
+        self.entries.pop(str(_id), None)
+
+    def deleted(self, _id) -> None:
+        self.put(_id, None)
+        for listener in self.delete_listeners:
+            listener(str(_id))
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "negative_size": len(self.negatives),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+        }
+
+
+class ExpiryIndex:
+    """
+    Min-heap of the expires_at of every file this process has seen, so expired files
+    can be deleted by a background task at the moment they expire instead of by
+    whichever request finds them first.
+    """
+    def __init__(self):
+        self.heap: List[Tuple[float, str]] = []
+        self.expires: Dict[str, float] = {}  # _id -> expires_at, the heap may hold stale entries
+        self.changed = asyncio.Event()
+
+    def track(self, _id, expires_at: Optional[float]) -> None:
+        if expires_at is None:
+            return
+        key = str(_id)
+        if self.expires.get(key) == expires_at:
+            return
+        self.expires[key] = expires_at
+        heapq.heappush(self.heap, (expires_at, key))
+        if self.heap[0][1] == key:
+            self.changed.set()
+
+    def forget(self, _id) -> None:
+        self.expires.pop(str(_id), None)
+
+    def due(self, now: float) -> List[str]:
+        """Pops the ids expired by `now`"""
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            expires_at, key = heapq.heappop(self.heap)
+            if self.expires.get(key) == expires_at:
+                del self.expires[key]
+                expired.append(key)
+        return expired
+
+    async def wait(self, timeout: float) -> None:
+        """Sleeps until the next expiry, an earlier one being tracked, or `timeout`"""
+        if self.heap:
+            timeout = min(timeout, max(self.heap[0][0] - time.time(), 0))
+        self.changed.clear()
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
 class Database:
     def __init__(self, uri, database_name):
         self._client = motor.motor_asyncio.AsyncIOMotorClient(uri)
@@ -14,6 +150,44 @@ class Database:
         self.file = self.db.file
         self.requests = self.db.active_requests  # New collection for tracking active requests
 
+# ---------------------[ INDEXES ]---------------------#
+    async def ensure_indexes(self):
+        """
+        Creates the indexes every lookup of this class relies on. Creating an existing index is a no-op,
+        a failure (e.g. duplicates blocking a unique index) is logged and startup goes on without it.
+        """
+        indexes = [
+            (self.file, [("user_id", pymongo.ASCENDING), ("file_unique_id", pymongo.ASCENDING)], {"unique": True}),
+            (self.file, [("user_id", pymongo.ASCENDING), ("_id", pymongo.DESCENDING)], {}),
+            (self.file, [("file_unique_id", pymongo.ASCENDING)], {}),
+            (self.file, [("expires_at", pymongo.ASCENDING)], {}),
+            (self.file, [("auth_channel_id", pymongo.ASCENDING)], {"sparse": True}),
+            (self.col, [("id", pymongo.ASCENDING)], {"unique": True}),
+            (self.black, [("id", pymongo.ASCENDING)], {"unique": True}),
+            (self.requests, [("user_id", pymongo.ASCENDING)], {}),
+            (self.requests, [("start_time", pymongo.ASCENDING)], {}),
+        ]
+        if Server.MONGO_TTL_EXPIRY:
+            # MongoDB only expires BSON dates, expires_at is a float timestamp
+            indexes.append((self.file, [("expires_on", pymongo.ASCENDING)], {"expireAfterSeconds": 0}))
+        for collection, keys, options in indexes:
+            try:
+                await collection.create_index(keys, **options)
+            except PyMongoError as e:
+                logging.warning(f"Couldn't create index {keys} on {collection.name}: {e}")
+
+        if Server.MONGO_TTL_EXPIRY:
+            try:
+                # Files stored before expires_on existed
+                result = await self.file.update_many(
+                    {"expires_at": {"$exists": True}, "expires_on": {"$exists": False}},
+                    [{"$set": {"expires_on": {"$toDate": {"$multiply": ["$expires_at", 1000]}}}}],
+                )
+                if result.modified_count:
+                    logging.info(f"Added expires_on to {result.modified_count} files")
+            except PyMongoError as e:
+                logging.warning(f"Couldn't add expires_on to existing files: {e}")
+
 #---------------------[ NEW USER ]---------------------#
     def new_user(self, id):
         return dict(
@@ -25,7 +199,10 @@ class Database:
 # ---------------------[ ADD USER ]---------------------#
     async def add_user(self, id):
         user = self.new_user(id)
-        await self.col.insert_one(user)
+        try:
+            await self.col.insert_one(user)
+        except DuplicateKeyError:
+            pass  # Added meanwhile by a concurrent message
 
 # ---------------------[ GET USER ]---------------------#
     async def get_user(self, id):
@@ -71,11 +248,24 @@ class Database:
     async def add_file(self, file_info):
         file_info["time"] = time.time()
         file_info["expires_at"] = time.time() + 3600  # Add expiration time (1 hour)
+        file_info["expires_on"] = datetime.fromtimestamp(file_info["expires_at"], timezone.utc)  # For the TTL index
         fetch_old = await self.get_file_by_fileuniqueid(file_info["user_id"], file_info["file_unique_id"])
         if fetch_old:
             return fetch_old["_id"]
+        return await self.insert_file(file_info)
+
+    async def insert_file(self, file_info):
+        """Inserts a new file, or returns the _id of the same file stored meanwhile by a concurrent message"""
+        try:
+            inserted_id = (await self.file.insert_one(file_info)).inserted_id
+        except DuplicateKeyError:
+            fetch_old = await self.get_file_by_fileuniqueid(file_info["user_id"], file_info["file_unique_id"])
+            if not fetch_old:
+                raise
+            return fetch_old["_id"]
         await self.count_links(file_info["user_id"], "+")
-        return (await self.file.insert_one(file_info)).inserted_id
+        expiry_index.track(inserted_id, file_info["expires_at"])
+        return inserted_id
 
 # ---------------------[ FIND FILE IN DB ]---------------------#
     async def find_files(self, user_id, range):
@@ -87,10 +277,17 @@ class Database:
         return user_files, total_files
 
     async def get_file(self, _id):
+        hit, file_info = file_doc_cache.get(_id)
+        if hit:
+            if not file_info:
+                raise FIleNotFound
+            return file_info
         try:
             file_info=await self.file.find_one({"_id": ObjectId(_id)})
+            file_doc_cache.put(_id, file_info)
             if not file_info:
                 raise FIleNotFound
+            expiry_index.track(_id, file_info.get("expires_at"))
             return file_info
         except InvalidId:
             raise FIleNotFound
@@ -113,10 +310,24 @@ class Database:
 # ---------------------[ DELETE FILES ]---------------------#
     async def delete_one_file(self, _id):
         await self.file.delete_one({'_id': ObjectId(_id)})
+        file_doc_cache.deleted(_id)
+        expiry_index.forget(_id)
+
+    async def delete_expired_file(self, _id):
+        """Deletes the file if it has expired and returns its document, None if it was already gone or renewed"""
+        file_info = await self.file.find_one_and_delete({'_id': ObjectId(_id), 'expires_at': {'$lte': time.time()}})
+        if file_info:
+            await self.count_links(file_info["user_id"], "-")
+            file_doc_cache.deleted(_id)
+        return file_info
 
 # ---------------------[ UPDATE FILES ]---------------------#
-    async def update_file_ids(self, _id, file_ids: dict):
-        await self.file.update_one({"_id": ObjectId(_id)}, {"$set": {"file_ids": file_ids}})
+    async def update_file_ids(self, _id, file_ids: dict, log_msg_id=None):
+        update = {"file_ids": file_ids}
+        if log_msg_id:
+            update["log_msg_id"] = log_msg_id  # Copy in FLOG_CHANNEL used to refresh file references
+        await self.file.update_one({"_id": ObjectId(_id)}, {"$set": update})
+        file_doc_cache.forget(_id)
 
 # ---------------------[ PAID SYS ]---------------------#
 #     async def link_available(self, id):
@@ -189,6 +400,7 @@ class Database:
         """Add file from authorized channel with special handling"""
         file_info["time"] = time.time()
         file_info["expires_at"] = time.time() + 3600  # 1 hour expiration
+        file_info["expires_on"] = datetime.fromtimestamp(file_info["expires_at"], timezone.utc)  # For the TTL index
         file_info["from_auth_channel"] = True
         file_info["auth_channel_id"] = channel_id
         file_info["download_enabled"] = True  # Enable download links for auth channel files
@@ -197,8 +409,7 @@ class Database:
         if fetch_old:
             return fetch_old["_id"]
         
-        await self.count_links(file_info["user_id"], "+")
-        return (await self.file.insert_one(file_info)).inserted_id
+        return await self.insert_file(file_info)
 
     async def is_auth_channel_file(self, file_id):
         """Check if file is from authorized channel"""
@@ -222,20 +433,23 @@ class Database:
     async def delete_expired_files(self):
         """Delete all expired files from database"""
         current_time = time.time()
-        expired_files = await self.file.find({"expires_at": {"$lt": current_time}}).to_list(None)
+        expired_files = await self.file.find({"expires_at": {"$lt": current_time}}, {"_id": 1}).to_list(None)
         
         deleted_count = 0
         for file_doc in expired_files:
-            # Decrease user's link count
-            await self.count_links(file_doc["user_id"], "-")
-            deleted_count += 1
-        
-        # Delete all expired files
-        result = await self.file.delete_many({"expires_at": {"$lt": current_time}})
-        return result.deleted_count
+            # Deleting one by one keeps the link count right when the expiry task reaps the same file
+            if await self.delete_expired_file(file_doc["_id"]):
+                deleted_count += 1
+        return deleted_count
 
     async def cleanup_old_requests(self):
         """Clean up old active requests (older than 5 minutes)"""
         old_time = time.time() - 300  # 5 minutes ago
         result = await self.requests.delete_many({"start_time": {"$lt": old_time}})
-        return result.deleted_count
\ No newline at end of file
+        return result.deleted_count
+
+# Global instances
+file_doc_cache = FileDocCache(
+    Server.FILE_DOC_CACHE_SIZE, Server.FILE_DOC_CACHE_TTL, Server.FILE_DOC_NEGATIVE_SIZE, Server.FILE_DOC_NEGATIVE_TTL
+)
+expiry_index = ExpiryIndex()
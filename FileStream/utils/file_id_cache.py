@@ -0,0 +1,83 @@
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+from pyrogram.file_id import FileId
+from FileStream.config import Server
+from FileStream.utils.database import file_doc_cache
+
+class FileIdCache:
+    """
+    Process-wide LRU cache of the FileIds resolved by every client, keyed by (client index, db_id).
+    An entry lives for FILE_ID_CACHE_TTL seconds and never past the file's own expires_at.
+    """
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size  # Entries kept, 0 disables the cache
+        self.ttl = ttl
+        self.entries: "OrderedDict[Tuple[int, str], Tuple[FileId, float]]" = OrderedDict()  # -> (file_id, valid until)
+        self.dcs: "OrderedDict[str, int]" = OrderedDict()  # db_id -> dc_id
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, index: int, db_id: str) -> Optional[FileId]:
+        key = (index, db_id)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        file_id, valid_until = entry
+        if time.time() >= valid_until:
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return file_id
+
+    def dc_id(self, db_id: str) -> Optional[int]:
+        """DC of the file as seen by any client that resolved it, without touching the counters"""
+        dc_id = self.dcs.get(db_id)
+        if dc_id is not None:
+            self.dcs.move_to_end(db_id)
+        return dc_id
+
+    def put(self, index: int, db_id: str, file_id: FileId) -> None:
+        if self.max_size <= 0:
+            return
+        valid_until = time.time() + self.ttl
+        expires_at = getattr(file_id, "expires_at", None)
+        if expires_at is not None:
+            valid_until = min(valid_until, expires_at)
+        key = (index, db_id)
+        self.entries[key] = (file_id, valid_until)
+        self.entries.move_to_end(key)
+        # A file never moves between DCs, so this side map only needs a size bound
+        self.dcs[db_id] = file_id.dc_id
+        self.dcs.move_to_end(db_id)
+        while len(self.dcs) > self.max_size:
+            self.dcs.popitem(last=False)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, db_id: str) -> None:
+        """Drops the file for every client"""
+        for key in [key for key in self.entries if key[1] == db_id]:
+            del self.entries[key]
+        self.dcs.pop(db_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+# Global instance
+file_id_cache = FileIdCache(Server.FILE_ID_CACHE_SIZE, Server.FILE_ID_CACHE_TTL)
+file_doc_cache.delete_listeners.append(file_id_cache.invalidate)
@@ -0,0 +1,58 @@
+import time
+import mimetypes
+from collections import OrderedDict
+from typing import Optional
+from FileStream.config import Server
+from FileStream.utils.file_properties import db
+from FileStream.utils.database import file_doc_cache
+
+class FileMeta:
+    """
+    What the HTTP layer needs to know about a stored file: enough to answer HEAD,
+    304 and 416 requests without any Telegram call.
+    """
+    def __init__(self, file_info: dict):
+        self.db_id = str(file_info["_id"])
+        self.file_size = file_info["file_size"]
+        self.file_name = file_info["file_name"]
+        self.mime_type = file_info.get("mime_type") or mimetypes.guess_type(self.file_name)[0] or "application/octet-stream"
+        self.last_modified: Optional[float] = file_info.get("time")
+        self.expires_at: Optional[float] = file_info.get("expires_at")  # None for files stored before expiry existed
+        self.etag = f'"{self.db_id}-{self.file_size}"'
+        self.loaded_at = time.time()
+
+    @property
+    def expired(self) -> bool:
+        return self.expires_at is not None and time.time() >= self.expires_at
+
+
+class FileMetaCache:
+    """
+    Process-wide LRU cache of FileMeta, each entry kept for META_CACHE_TTL seconds
+    and never past the file's own expiry.
+    """
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, FileMeta]" = OrderedDict()
+
+    async def get(self, db_id: str) -> FileMeta:
+        """Returns the metadata of a file, raises FIleNotFound like Database.get_file"""
+        meta = self.entries.get(db_id)
+        if meta is not None and time.time() - meta.loaded_at < self.ttl and not meta.expired:
+            self.entries.move_to_end(db_id)
+            return meta
+        meta = FileMeta(await db.get_file(db_id))
+        if self.max_size > 0:
+            self.entries[db_id] = meta
+            self.entries.move_to_end(db_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return meta
+
+    def invalidate(self, db_id: str) -> None:
+        self.entries.pop(db_id, None)
+
+# Global instance
+file_meta_cache = FileMetaCache(Server.META_CACHE_SIZE, Server.META_CACHE_TTL)
+file_doc_cache.delete_listeners.append(file_meta_cache.invalidate)
@@ -29,15 +29,13 @@ async def get_file_ids(client: Client | bool, db_id: str, multi_clients, message
     expires_at = file_info.get('expires_at', current_time + 3600)  # Fallback for old files
     
     if current_time >= expires_at:
-        # File has expired, delete it
-        await db.delete_one_file(file_info['_id'])
-        await db.count_links(file_info['user_id'], "-")
+        # File has expired, the expiry task deletes it
         raise Exception("File has expired and has been automatically deleted")
     
     if (not "file_ids" in file_info) or not client:
         logging.debug("Storing file_id of all clients in DB")
         log_msg = await send_file(FileStream, db_id, file_info['file_id'], message)
-        await db.update_file_ids(db_id, await update_file_id(log_msg.id, multi_clients))
+        await db.update_file_ids(db_id, await update_file_id(log_msg.id, multi_clients), log_msg.id)
         logging.debug("Stored file_id of all clients in DB")
         if not client:
             return
@@ -50,7 +48,7 @@ async def get_file_ids(client: Client | bool, db_id: str, multi_clients, message
         msg = await client.get_messages(Telegram.FLOG_CHANNEL, log_msg.id)
         media = get_media_from_message(msg)
         file_id_info[str(client.id)] = getattr(media, "file_id", "")
-        await db.update_file_ids(db_id, file_id_info)
+        await db.update_file_ids(db_id, file_id_info, log_msg.id)
         logging.debug("Stored file_id in DB")
 
     logging.debug("Middle of get_file_ids")
@@ -59,10 +57,32 @@ async def get_file_ids(client: Client | bool, db_id: str, multi_clients, message
     setattr(file_id, "mime_type", file_info['mime_type'])
     setattr(file_id, "file_name", file_info['file_name'])
     setattr(file_id, "unique_id", file_info['file_unique_id'])
+    setattr(file_id, "expires_at", file_info.get('expires_at'))
     logging.debug("Ending of get_file_ids")
     return file_id
 
 
+async def refresh_file_id(client: Client, db_id: str, multi_clients) -> FileId:
+    """
+    Reads the file's copy in FLOG_CHANNEL again with `client` to get a fresh file_reference.
+    Files stored before the copy's message id was recorded get a new copy first.
+    """
+    file_info = await db.get_file(db_id)
+    log_msg_id = file_info.get("log_msg_id")
+    if not log_msg_id:
+        log_msg = await FileStream.send_cached_media(chat_id=Telegram.FLOG_CHANNEL, file_id=file_info['file_id'],
+                                                     caption=f"**{file_info['file_name']}**")
+        log_msg_id = log_msg.id
+
+    msg = await client.get_messages(Telegram.FLOG_CHANNEL, log_msg_id)
+    media = get_media_from_message(msg)
+    file_id_info = file_info.setdefault("file_ids", {})
+    file_id_info[str(client.id)] = getattr(media, "file_id", "")
+    await db.update_file_ids(db_id, file_id_info, log_msg_id)
+    logging.debug(f"Refreshed file_id of {db_id} for client {client.id}")
+    return await get_file_ids(client, db_id, multi_clients, Message)
+
+
 def get_media_from_message(message: "Message") -> Any:
     media_types = (
         "audio",
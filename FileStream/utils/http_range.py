@@ -0,0 +1,122 @@
+import secrets
+from email.utils import parsedate_to_datetime
+from typing import AsyncGenerator, Callable, List, Optional, Tuple, Union
+from FileStream.server.exceptions import RangeNotSatisfiable
+
+MAX_RANGES = 16  # Requests asking for more (coalesced) ranges get the whole file
+
+def parse_range(header: str, file_size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parses a Range header (RFC 7233) into sorted, coalesced, inclusive (start, end) byte ranges
+    clamped to the file. Supports `a-b`, open `a-` and suffix `-n` ranges.
+    Returns None when the header must be ignored (other unit, bad syntax, too many ranges),
+    raises RangeNotSatisfiable when none of the ranges overlaps the file.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, dash, last = part.partition("-")
+        first, last = first.strip(), last.strip()
+        if not dash or (first and not first.isdigit()) or (last and not last.isdigit()) or not (first or last):
+            return None
+        if not first:
+            # Suffix range: the last `n` bytes
+            length = int(last)
+            if length == 0:
+                continue
+            ranges.append((max(file_size - length, 0), file_size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start >= file_size:
+            continue
+        end = int(last) if last else file_size - 1
+        ranges.append((start, min(end, file_size - 1)))
+
+    if not ranges or file_size == 0:
+        raise RangeNotSatisfiable
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+
+def if_range_matches(if_range: Optional[str], etag: str, last_modified: Optional[float] = None) -> bool:
+    """
+    Whether a Range header may be honoured given the request's If-Range.
+    An entity tag must match strongly, a date must equal Last-Modified; anything else means
+    the representation changed and the whole file is sent.
+    """
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return not if_range.startswith("W/") and if_range == etag
+    if last_modified is None:
+        return False
+    try:
+        return int(parsedate_to_datetime(if_range).timestamp()) == int(last_modified)
+    except (TypeError, ValueError):
+        return False
+
+
+class MultipartRanges:
+    """
+    Body of a `multipart/byteranges` response: one part per range, each with its own
+    Content-Type and Content-Range headers.
+    """
+    def __init__(self, ranges: List[Tuple[int, int]], file_size: int, mime_type: str):
+        self.ranges = ranges
+        self.file_size = file_size
+        self.mime_type = mime_type
+        self.boundary = secrets.token_hex(16)
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/byteranges; boundary={self.boundary}"
+
+    def part_header(self, start: int, end: int) -> bytes:
+        return (
+            f"--{self.boundary}\r\n"
+            f"Content-Type: {self.mime_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{self.file_size}\r\n\r\n"
+        ).encode()
+
+    def closing(self) -> bytes:
+        return f"--{self.boundary}--\r\n".encode()
+
+    def content_length(self) -> int:
+        length = len(self.closing())
+        for start, end in self.ranges:
+            length += len(self.part_header(start, end)) + end - start + 1 + 2
+        return length
+
+    async def body(
+        self, yield_range: Callable[[int, int], AsyncGenerator[Union[bytes, memoryview], None]]
+    ) -> AsyncGenerator[Union[bytes, memoryview], None]:
+        """Yields the parts, reading each range's bytes from yield_range(start, end)"""
+        for start, end in self.ranges:
+            yield self.part_header(start, end)
+            part = yield_range(start, end)
+            try:
+                async for chunk in part:
+                    yield chunk
+            finally:
+                await part.aclose()
+            yield b"\r\n"
+        yield self.closing()
@@ -1,27 +1,37 @@
-import aiohttp
 import jinja2
 import urllib.parse
 import time
+from typing import Optional
 from FileStream.config import Telegram, Server
 from FileStream.utils.database import Database
 from FileStream.utils.human_readable import humanbytes
 db = Database(Telegram.DATABASE_URL, Telegram.SESSION_NAME)
 
-async def render_page(db_id):
-    try:
-        file_data = await db.get_file(db_id)
-    except Exception:
-        # Return a 404-style page for file not found
-        return "<html><body><h1>File Not Found</h1><p>The requested file could not be found.</p></body></html>"
+def page_etag(file_data) -> Optional[str]:
+    """
+    Weak ETag of the watch page, which only changes with the file and the minute shown as time remaining.
+    None once the file has expired.
+    """
+    expires_at = file_data.get('expires_at', time.time() + 3600)
+    remaining_minutes = int(expires_at - time.time()) // 60
+    if remaining_minutes < 0:
+        return None
+    return f'W/"{file_data["_id"]}-{file_data["file_size"]}-{remaining_minutes}"'
+
+async def render_page(db_id, file_data=None):
+    if file_data is None:
+        try:
+            file_data = await db.get_file(db_id)
+        except Exception:
+            # Return a 404-style page for file not found
+            return "<html><body><h1>File Not Found</h1><p>The requested file could not be found.</p></body></html>"
     
     # Check if file has expired
     current_time = time.time()
     expires_at = file_data.get('expires_at', current_time + 3600)  # Fallback for old files
     
     if current_time >= expires_at:
-        # File has expired, delete it and show expired page
-        await db.delete_one_file(file_data['_id'])
-        await db.count_links(file_data['user_id'], "-")
+        # File has expired, show expired page and leave the deletion to the expiry task
         return "<html><body><h1>File Expired</h1><p>This file has expired and has been automatically deleted after 1 hour.</p></body></html>"
     
     src = urllib.parse.urljoin(Server.URL, f'dl/{file_data["_id"]}')
@@ -41,9 +51,6 @@ async def render_page(db_id):
         template_file = "FileStream/template/play.html"
     else:
         template_file = "FileStream/template/dl.html"
-        async with aiohttp.ClientSession() as s:
-            async with s.get(src) as u:
-                file_size = humanbytes(int(u.headers.get('Content-Length')))
 
     with open(template_file) as f:
         template = jinja2.Template(f.read())